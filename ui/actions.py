@@ -1,4 +1,4 @@
-import os
+import bisect
 import pydux
 from frozendict import frozendict
 
@@ -6,7 +6,7 @@ import logging
 log = logging.getLogger(__name__)
 
 import utility
-from functools import partial
+import library_index
 
 class Reducers():
     def init(self, _, state):
@@ -29,36 +29,100 @@ class Reducers():
     def go_to_menu(self, state, value):
         return state.copy(location = 'menu')
     def set_books(self, state, books):
-        width, height = dimensions(state)
-        books = map(lambda b: {'data': b, 'page':0}, books)
-        books = sort_books(books)
-        data = map(get_title, books)
-        data = map(partial(utility.pad_line, width), data)
-        library = frozendict({'data': tuple(data), 'page': 0})
-        return state.copy(location = 'library', books = tuple(books), library = library)
+        state = state.copy(books = tuple(), filenames = tuple(),
+                           library = frozendict({'data': tuple(), 'page': 0}))
+        state = self.add_books(state, books)
+        return state.copy(location = 'library')
     def add_books(self, state, books_to_add):
+        '''
+        add books to the library, going to the one being read when the state
+        was saved once it is added. The new books are sorted and merged in
+        filename order in one pass, and only their titles are rendered. A book
+        that is already in the library is replaced, keeping the page it is
+        open at.
+
+        the books, filenames and titles stay tuples, as the library pages and
+        :func:`find_location` index and bisect them. So each change still
+        copies them, a copy of pointers in slices rather than any work per
+        book.
+        '''
         width, height = dimensions(state)
-        book_filenames = map(lambda b: b['data'].filename, state['books'])
-        books_to_add = filter(lambda d: d.filename not in book_filenames, books_to_add)
-        books_to_add = map(lambda b: {'data': b, 'page':0}, books_to_add)
-        books = list(state['books'])
-        books += list(books_to_add)
-        books = sort_books(books)
-        data = map(get_title, books)
-        data = map(partial(utility.pad_line, width), data)
-        library = frozendict({'data': tuple(data), 'page': state['library']['page']})
-        return state.copy(books = tuple(books), library = library)
+        location = location_filename(state)
+        new_books = {}
+        for book in books_to_add:
+            new_books[book.filename] = book
+        old_books = state['books']
+        old_filenames = state['filenames']
+        old_data = state['library']['data']
+        books = []
+        filenames = []
+        data = []
+        # position in the old tuples merged up to
+        i = 0
+        for filename in sorted(new_books):
+            n = bisect.bisect_left(old_filenames, filename, i)
+            books += old_books[i:n]
+            filenames += old_filenames[i:n]
+            data += old_data[i:n]
+            book = new_books[filename]
+            books.append(book)
+            filenames.append(filename)
+            data.append(utility.pad_line(width, get_title(book)))
+            # skip over a book being replaced
+            i = n + 1 if n < len(old_filenames) and old_filenames[n] == filename else n
+        books += old_books[i:]
+        filenames += old_filenames[i:]
+        data += old_data[i:]
+        library = state['library'].copy(data = tuple(data))
+        # the navigation of a replaced book is read again when it is opened
+        navigation = state['navigation']
+        for filename in new_books:
+            navigation = navigation.remove(filename)
+        return state.copy(books = tuple(books), filenames = tuple(filenames),
+                          library = library, navigation = navigation,
+                          location = find_location(location, filenames))
     def remove_books(self, state, filenames):
+        '''
+        remove books from the library, forgetting where they were read up to.
+        Each book is found with a binary search and the rest of the library
+        is copied around it in slices.
+        '''
         width, height = dimensions(state)
-        books = filter(lambda b: b['data'].filename not in filenames, state['books'])
-        data = map(get_title, books)
-        data = map(partial(utility.pad_line, width), data)
+        location = location_filename(state)
+        filenames = set(filenames)
+        old_filenames = state['filenames']
+        removed = []
+        for filename in filenames:
+            n = bisect.bisect_left(old_filenames, filename)
+            if n < len(old_filenames) and old_filenames[n] == filename:
+                removed.append(n)
+        removed.sort()
+        books = []
+        kept_filenames = []
+        data = []
+        # position in the old tuples copied up to
+        i = 0
+        for n in removed + [len(old_filenames)]:
+            books += state['books'][i:n]
+            kept_filenames += old_filenames[i:n]
+            data += state['library']['data'][i:n]
+            i = n + 1
+        books = tuple(books)
+        kept_filenames = tuple(kept_filenames)
+        data = tuple(data)
         maximum = get_max_pages(data, height)
         page = state['library']['page']
         if page > maximum:
             page = maximum
         library = frozendict({'data': data, 'page': page})
-        return state.copy(books = tuple(books), library = library)
+        positions = state['positions']
+        navigation = state['navigation']
+        for filename in filenames:
+            positions = positions.remove(filename)
+            navigation = navigation.remove(filename)
+        return state.copy(books = books, filenames = kept_filenames, library = library,
+                          positions = positions, navigation = navigation,
+                          location = find_location(location, kept_filenames))
     def next_page(self, state, value):
         width, height = dimensions(state)
         location = state['location']
@@ -68,12 +132,7 @@ class Reducers():
             library = set_page(library, page, (height - 1))
             return state.copy(library = library)
         elif type(location) == int:
-            book = state['books'][location]
-            data = book['data']
-            page = book['page'] + 1
-            books = list(state['books'])
-            books[location] = set_page(book, page, height)
-            return state.copy(books = tuple(books))
+            return set_book_page(state, location, get_book_page(state, location) + 1)
         return state
     def previous_page(self, state, value):
         width, height = dimensions(state)
@@ -84,30 +143,24 @@ class Reducers():
             library = set_page(library, page, (height - 1))
             return state.copy(library = library)
         elif type(location) == int:
-            book = state['books'][location]
-            data = book['data']
-            page = book['page'] - 1
-            books = list(state['books'])
-            books[location] = set_page(book, page, height)
-            return state.copy(books = tuple(books))
+            return set_book_page(state, location, get_book_page(state, location) - 1)
         return state
     def go_to_start(self, state, value):
-        width, height = dimensions(state)
-        location = state['location']
-        book = state['books'][location]
-        page = 0
-        books = list(state['books'])
-        books[location] = set_page(book, page, height)
-        return state.copy(books = tuple(books))
+        return set_book_page(state, state['location'], 0)
     def skip_pages(self, state, value):
-        width, height = dimensions(state)
         location = state['location']
-        book = state['books'][location]
-        data = book['data']
-        page = book['page'] + value
-        books = list(state['books'])
-        books[location] = set_page(book, page, height)
-        return state.copy(books = tuple(books))
+        return set_book_page(state, location, get_book_page(state, location) + value)
+    def set_navigation(self, state, value):
+        '''
+        the pages that start a volume, section or heading of a book, given as
+        `(filename, pages)` once the book has been read
+        '''
+        filename, pages = value
+        return state.copy(navigation = state['navigation'].set(filename, tuple(pages)))
+    def next_section(self, state, value):
+        return go_to_section(state, 1)
+    def previous_section(self, state, value):
+        return go_to_section(state, -1)
     def replace_library(self, state, value):
         if state['replacing_library'] == 'in progress' and value != 'done':
             return state
@@ -134,9 +187,122 @@ class Reducers():
     def update_ui(self, state, value):
         return state.copy(update_ui = value)
 
+    def search(self, state, query):
+        '''search the library for the words typed as pin numbers in `query`'''
+        search = state['search'].copy(query = tuple(query), page = None,
+                                      searching = 'start', results = (), result = 0)
+        return state.copy(search = search)
+    def go_to_search(self, state, value):
+        '''start typing a new search'''
+        search = state['search'].copy(query = (), page = None, searching = False,
+                                      results = (), result = 0, typed = (), cell = 0)
+        return state.copy(location = 'search', search = search)
+    def type_dot(self, state, dot):
+        '''raise or lower `dot` (1 to 6) of the cell being typed'''
+        cell = state['search']['cell'] ^ (1 << (dot - 1))
+        return state.copy(search = state['search'].copy(cell = cell))
+    def type_cell(self, state, value):
+        '''add the cell being typed to the query, a blank one is a space'''
+        search = state['search']
+        search = search.copy(typed = search['typed'] + (search['cell'],), cell = 0)
+        return state.copy(search = search)
+    def delete_cell(self, state, value):
+        '''clear the cell being typed, or if it is blank the last one typed'''
+        search = state['search']
+        if search['cell']:
+            return state.copy(search = search.copy(cell = 0))
+        return state.copy(search = search.copy(typed = search['typed'][:-1]))
+    def search_typed(self, state, value):
+        '''search for what has been typed, including the cell being typed'''
+        return self.search(state, typed_query(state['search']))
+    def search_started(self, state, value):
+        return state.copy(search = state['search'].copy(searching = 'in progress'))
+    def search_results(self, state, results):
+        '''the `(filename, page)` of each page found, go to the first one'''
+        search = state['search'].copy(searching = False, results = tuple(results))
+        return go_to_search_result(state.copy(search = search), 0)
+    def next_search_result(self, state, value):
+        results = state['search']['results']
+        if results == ():
+            return state
+        return go_to_search_result(state, (state['search']['result'] + 1) % len(results))
+    def search_page(self, state, value):
+        '''
+        go to the next search result, or if the page being read isn't the
+        current result search the library for the words on its first row. The
+        row is read by the search rather than here, so no book is read while
+        reducing.
+        '''
+        location = state['location']
+        page = (state['filenames'][location], get_book_page(state, location))
+        search = state['search']
+        results = search['results']
+        if search['result'] < len(results):
+            if results[search['result']] == page:
+                return self.next_search_result(state, value)
+        search = search.copy(query = (), page = page, searching = 'start',
+                             results = (), result = 0)
+        return state.copy(search = search)
+
+
+def typed_query(search):
+    ''':rtype: the cells typed so far, including the one being typed'''
+    if search['cell']:
+        return search['typed'] + (search['cell'],)
+    return search['typed']
+
+
+def location_filename(state):
+    ''':rtype: the location with a book given by its filename rather than number'''
+    location = state['location']
+    if type(location) == int:
+        return state['filenames'][location]
+    return location
 
-def sort_books(books):
-    return sorted(books, key=lambda book: book['data'].filename)
+
+def find_location(location, filenames):
+    '''
+    :param filenames: sorted filenames of the books in the library
+    :rtype: the location with a book filename turned back into its number,
+    or the library if the book isn't there
+    '''
+    if location in ('library', 'menu', 'search'):
+        return location
+    n = bisect.bisect_left(filenames, location)
+    if n < len(filenames) and filenames[n] == location:
+        return n
+    return 'library'
+
+
+def go_to_section(state, direction):
+    '''
+    go to the next (or previous if `direction` is negative) marked page. Only
+    the marks already in the state are used, nothing is read from the book.
+    '''
+    location = state['location']
+    pages = state['navigation'].get(state['filenames'][location], ())
+    page = get_book_page(state, location)
+    if direction > 0:
+        n = bisect.bisect_right(pages, page)
+    else:
+        n = bisect.bisect_left(pages, page) - 1
+    if n < 0 or n >= len(pages):
+        return state
+    return set_book_page(state, location, pages[n])
+
+
+def go_to_search_result(state, number):
+    width, height = dimensions(state)
+    search = state['search'].copy(result = number)
+    results = search['results']
+    if number >= len(results):
+        return state.copy(search = search)
+    filename, page = results[number]
+    location = find_location(filename, state['filenames'])
+    if location != 'library':
+        return set_book_page(state, location, page).copy(location = location, search = search)
+    log.warning('no book {} for search result'.format(filename))
+    return state.copy(search = search)
 
 
 def dimensions(state):
@@ -146,19 +312,39 @@ def dimensions(state):
 
 
 def get_title(book):
-    basename = os.path.basename(book['data'].filename)
-    title = os.path.splitext(basename)[0].replace('_', ' ')
-    return utility.alphas_to_pin_nums(title)
+    title = book.title
+    if title is None:
+        return library_index.title(book.filename)
+    # a copy as the title is padded in place
+    return list(title)
 
 
-def set_page(book, page, height):
-    data = book['data']
+def set_page(library, page, height):
+    data = library['data']
     if page < 0 or page > get_max_pages(data, height):
-        return book
+        return library
     else:
         return frozendict({'data': data, 'page': page})
 
 
+def get_book_page(state, location):
+    ''':rtype: the page the book at `location` is open at'''
+    return state['positions'].get(state['filenames'][location], 0)
+
+
+def set_book_page(state, location, page):
+    '''
+    open the book at `location` at `page` if it has that page. Only the
+    book's entry in the positions map changes, so this doesn't depend on how
+    many books there are.
+    '''
+    width, height = dimensions(state)
+    book = state['books'][location]
+    if page < 0 or page > get_max_pages(book, height):
+        return state
+    return state.copy(positions = state['positions'].set(book.filename, page))
+
+
 def get_max_pages(data, height):
     return (len(data) - 1) // height
 
@@ -55,3 +55,10 @@ parser.add_argument('--both',
         help="run both the emulator and the real hardware at the same time"
 )
 
+parser.add_argument('--profile-actions',
+        action='store_const',
+        dest='profile_actions',
+        const=True,
+        default=False,
+        help="count and time actions, logged on exit or when sent SIGUSR1"
+)
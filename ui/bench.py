@@ -0,0 +1,449 @@
+#!/usr/bin/env python
+'''
+Benchmarks
+==========
+
+measures the ui over a directory of books (by default the bundled `books/`
+corpus) and writes the results as JSON.
+
+* `convert` times the conversion engines. Each book is converted in its own
+  process so the peak RSS reported is for that book alone. Save a run with
+  `--output` and pass it back with `--baseline` to compare; the exit status is
+  non-zero if the aggregate throughput has dropped by more than `--tolerance`.
+* `pages` converts each book both uncompressed and compressed and compares
+  their size on disk and how long it takes to fetch a page.
+* `positions` times turning pages of a book in libraries of
+  :data:`LIBRARY_SIZES` books, which shouldn't depend on the library size.
+* `serial` times sending whole pages through the Pi driver to a stand-in for
+  the display's firmware on a pty, for each of :data:`WINDOWS` rows in flight
+  and for firmware that takes a whole page at once.
+'''
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import pty
+import Queue
+import random
+import resource
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+import convert
+import utility
+import actions
+from initial_state import initial_state
+from bookfile_list import BookFile_List
+from driver_pi import Pi
+import comms_codes as comms
+
+log = logging.getLogger(__name__)
+
+LIBRARY_SIZES = (100, 1000, 10000)
+WINDOWS = (1, 2, 4, 8)
+
+# conversion engine for each book extension
+ENGINES = {
+    'brf': convert.convert_brf,
+    'pef': convert.convert_pef,
+    'txt': convert.convert_txt,
+}
+
+
+def _convert_child(engine, width, height, book_file, native_file, results):
+    start = time.time()
+    try:
+        ENGINES[engine](width, height, book_file, native_file, remove=False)
+    except Exception as e:
+        results.put(str(e))
+        return
+    seconds = time.time() - start
+    rows = len(BookFile_List(native_file, width)) if os.path.exists(native_file) else 0
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((seconds, rows, peak_rss_kb))
+
+
+def bench_file(engine, width, height, book_file, out_dir, repeat=1):
+    '''
+    convert one book `repeat` times, each in a fresh process
+
+    :rtype: dict of the results for the fastest run, or None if the book
+    couldn't be converted
+    '''
+    native_file = os.path.join(out_dir, 'bench.canute')
+    best = None
+    for _ in range(repeat):
+        results = multiprocessing.Queue()
+        child = multiprocessing.Process(target=_convert_child,
+            args=(engine, width, height, book_file, native_file, results))
+        child.start()
+        run = None
+        # the child may die without putting anything on the queue
+        while run is None and (child.is_alive() or not results.empty()):
+            try:
+                run = results.get(timeout=1)
+            except Queue.Empty:
+                pass
+        child.join()
+        if run is None:
+            log.error('converting %s failed, exit code %s' % (book_file, child.exitcode))
+            return None
+        if isinstance(run, str):
+            log.error('converting %s failed: %s' % (book_file, run))
+            return None
+        if best is None or run[0] < best[0]:
+            best = run
+    seconds, rows, peak_rss_kb = best
+    size = os.path.getsize(book_file)
+    return {
+        'file': os.path.basename(book_file),
+        'engine': engine,
+        'bytes': size,
+        'rows': rows,
+        'seconds': seconds,
+        'mb_per_s': size / seconds / 1e6 if seconds else 0,
+        'rows_per_s': rows / seconds if seconds else 0,
+        'peak_rss_kb': peak_rss_kb,
+    }
+
+
+def bench_convert(books_dir, width, height, repeat=1):
+    out_dir = tempfile.mkdtemp()
+    try:
+        files = []
+        for book_file in sorted(utility.find_files(books_dir, ENGINES.keys())):
+            engine = os.path.splitext(book_file)[1][1:].lower()
+            result = bench_file(engine, width, height, book_file, out_dir, repeat)
+            if result is None:
+                continue
+            log.info('%-60s %8.2f MB/s %10.0f rows/s' % (result['file'][:60],
+                     result['mb_per_s'], result['rows_per_s']))
+            files.append(result)
+    finally:
+        shutil.rmtree(out_dir)
+    return {
+        'benchmark': 'convert',
+        'width': width,
+        'height': height,
+        'files': files,
+        'total': total(files),
+    }
+
+
+def time_page_fetches(native_file, width, height, samples):
+    '''
+    :rtype: tuple of the mean seconds to fetch a page and the mean bytes
+    stored per page
+    '''
+    book = BookFile_List(native_file, width, height)
+    pages = len(book) // height
+    rand = random.Random(0)
+    numbers = [rand.randrange(pages) for _ in range(samples)]
+    start = time.time()
+    for n in numbers:
+        book[n * height:(n + 1) * height]
+    seconds = (time.time() - start) / samples
+    return seconds, float(book.header.index_offset - book.data_offset) / pages
+
+
+def bench_pages(books_dir, width, height, samples=200):
+    out_dir = tempfile.mkdtemp()
+    raw_file = os.path.join(out_dir, 'raw.canute')
+    compressed_file = os.path.join(out_dir, 'compressed.canute')
+    try:
+        files = []
+        for book_file in sorted(utility.find_files(books_dir, ENGINES.keys())):
+            engine = os.path.splitext(book_file)[1][1:].lower()
+            ENGINES[engine](width, height, book_file, raw_file, remove=False)
+            if not os.path.exists(raw_file):
+                continue
+            if len(BookFile_List(raw_file, width, height)) < height:
+                log.info('%-50s has no pages' % os.path.basename(book_file)[:50])
+                os.remove(raw_file)
+                continue
+            ENGINES[engine](width, height, book_file, compressed_file,
+                            remove=False, compress=True)
+            raw_seconds, raw_page_bytes = time_page_fetches(raw_file, width, height, samples)
+            seconds, page_bytes = time_page_fetches(compressed_file, width, height, samples)
+            result = {
+                'file': os.path.basename(book_file),
+                'pages': len(BookFile_List(raw_file, width)) // height,
+                'raw_bytes': os.path.getsize(raw_file),
+                'compressed_bytes': os.path.getsize(compressed_file),
+                'raw_page_bytes': raw_page_bytes,
+                'compressed_page_bytes': page_bytes,
+                'raw_fetch_us': raw_seconds * 1e6,
+                'compressed_fetch_us': seconds * 1e6,
+            }
+            log.info('%-50s %5.1f%% size %7.1f us raw %7.1f us compressed' % (
+                     result['file'][:50],
+                     100.0 * result['compressed_bytes'] / result['raw_bytes'],
+                     result['raw_fetch_us'], result['compressed_fetch_us']))
+            files.append(result)
+            os.remove(raw_file)
+            os.remove(compressed_file)
+    finally:
+        shutil.rmtree(out_dir)
+    raw_bytes = sum(f['raw_bytes'] for f in files)
+    compressed_bytes = sum(f['compressed_bytes'] for f in files)
+    return {
+        'benchmark': 'pages',
+        'width': width,
+        'height': height,
+        'files': files,
+        'total': {
+            'files': len(files),
+            'raw_bytes': raw_bytes,
+            'compressed_bytes': compressed_bytes,
+            'compression_ratio': float(compressed_bytes) / raw_bytes if raw_bytes else 0,
+            'raw_fetch_us': mean([f['raw_fetch_us'] for f in files]),
+            'compressed_fetch_us': mean([f['compressed_fetch_us'] for f in files]),
+        },
+    }
+
+
+class _Book(object):
+    '''stands in for a BookFile_List of `rows` rows without a file'''
+    def __init__(self, filename, rows):
+        self.filename = filename
+        self.title = None
+        self.rows = rows
+
+    def __len__(self):
+        return self.rows
+
+
+def bench_positions(height, turns=1000):
+    reducers = actions.Reducers()
+    sizes = []
+    for size in LIBRARY_SIZES:
+        books = [_Book('/books/%06d.canute' % n, height * 1000) for n in range(size)]
+        state = reducers.add_books(initial_state, books)
+        state = state.copy(location = size // 2)
+        start = time.time()
+        for _ in range(turns // 2):
+            state = reducers.next_page(state, None)
+        for _ in range(turns // 2):
+            state = reducers.previous_page(state, None)
+        seconds = (time.time() - start) / turns
+        log.info('%6d books %8.1f us per page turn' % (size, seconds * 1e6))
+        sizes.append({'books': size, 'turn_us': seconds * 1e6})
+    return {
+        'benchmark': 'positions',
+        'height': height,
+        'turns': turns,
+        'sizes': sizes,
+    }
+
+
+def _read(fd, size):
+    data = ''
+    while len(data) < size:
+        data += os.read(fd, size - len(data))
+    return data
+
+
+def _sleep_until(due):
+    delay = due - time.time()
+    if delay > 0:
+        time.sleep(delay)
+
+
+def _firmware(fd, width, height, latency, row_seconds, version):
+    '''
+    stands in for the display's firmware on the other end of a pty. Each
+    command reaches it `latency` seconds after it was written and its reply
+    takes as long to get back, while setting a row takes `row_seconds`.
+    Commands are carried out one at a time, in order. Firmware of `version`
+    0 doesn't answer the version query or take whole pages.
+    '''
+    commands = Queue.Queue()
+    replies = Queue.Queue()
+
+    def receive():
+        while True:
+            cmd = ord(_read(fd, 1))
+            if cmd == comms.CMD_SEND_LINE:
+                _read(fd, width + 1)
+            elif cmd == comms.CMD_SEND_PAGE:
+                _read(fd, width * height)
+            commands.put((time.time() + latency, cmd))
+
+    def reply():
+        while True:
+            due, message = replies.get()
+            _sleep_until(due)
+            os.write(fd, message)
+
+    for target in (receive, reply):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+    answers = {comms.CMD_GET_CHARS: width, comms.CMD_GET_ROWS: height,
+               comms.CMD_SEND_VERSION: version}
+    while True:
+        due, cmd = commands.get()
+        _sleep_until(due)
+        if cmd == comms.CMD_SEND_LINE:
+            time.sleep(row_seconds)
+        elif cmd == comms.CMD_SEND_PAGE:
+            time.sleep(row_seconds * height)
+        elif cmd == comms.CMD_SEND_VERSION and not version:
+            continue
+        message = struct.pack('2b', cmd, answers.get(cmd, 0))
+        replies.put((time.time() + latency, message))
+
+
+def time_pages(width, height, latency, row_seconds, window, version, pages):
+    ''':rtype: mean seconds to send a page through the Pi driver'''
+    master, slave = pty.openpty()
+    firmware = multiprocessing.Process(target=_firmware,
+        args=(master, width, height, latency, row_seconds, version))
+    firmware.daemon = True
+    firmware.start()
+    try:
+        driver = Pi(os.ttyname(slave), timeout=10, window=window)
+        start = time.time()
+        for n in range(pages):
+            # every row changes so none are skipped
+            driver.set_braille([n % 63 + 1] * width * height)
+        seconds = (time.time() - start) / pages
+        driver.port.close()
+    finally:
+        firmware.terminate()
+        os.close(master)
+        os.close(slave)
+    return seconds
+
+
+def bench_serial(width, height, latency, row_seconds, pages=10):
+    runs = [(window, 0) for window in WINDOWS] + [(1, comms.VERSION_SEND_PAGE)]
+    results = []
+    for window, version in runs:
+        seconds = time_pages(width, height, latency, row_seconds, window, version, pages)
+        if version:
+            log.info('whole pages      %8.1f ms per page' % (seconds * 1000))
+        else:
+            log.info('%d rows in flight %8.1f ms per page' % (window, seconds * 1000))
+        results.append({'window': window, 'send_pages': bool(version),
+                        'page_ms': seconds * 1000})
+    stop_and_wait = results[0]['page_ms']
+    for result in results:
+        result['saved'] = 1 - result['page_ms'] / stop_and_wait
+    return {
+        'benchmark': 'serial',
+        'width': width,
+        'height': height,
+        'latency_ms': latency * 1000,
+        'row_ms': row_seconds * 1000,
+        'pages': pages,
+        'runs': results,
+    }
+
+
+def mean(values):
+    return sum(values) / len(values) if values else 0
+
+
+def total(files):
+    size = sum(f['bytes'] for f in files)
+    rows = sum(f['rows'] for f in files)
+    seconds = sum(f['seconds'] for f in files)
+    return {
+        'files': len(files),
+        'bytes': size,
+        'rows': rows,
+        'seconds': seconds,
+        'mb_per_s': size / seconds / 1e6 if seconds else 0,
+        'rows_per_s': rows / seconds if seconds else 0,
+        'peak_rss_kb': max([f['peak_rss_kb'] for f in files] or [0]),
+    }
+
+
+def compare(results, baseline, tolerance):
+    '''
+    log the change in throughput of each file against the baseline
+
+    :rtype: True if aggregate throughput is within tolerance of the baseline
+    '''
+    old_files = dict((f['file'], f) for f in baseline['files'])
+    for new in results['files']:
+        old = old_files.get(new['file'])
+        if old is None or not old['mb_per_s']:
+            continue
+        change = new['mb_per_s'] / old['mb_per_s'] - 1
+        log.info('%-60s %+7.1f%% MB/s %+7.1f%% peak RSS' % (new['file'][:60],
+                 change * 100, (float(new['peak_rss_kb']) / old['peak_rss_kb'] - 1) * 100))
+    old_total = baseline['total']['mb_per_s']
+    change = results['total']['mb_per_s'] / old_total - 1 if old_total else 0
+    log.info('total %+.1f%% MB/s (%.2f -> %.2f)' % (change * 100, old_total,
+             results['total']['mb_per_s']))
+    return change >= -tolerance
+
+
+BENCHMARKS = {
+    'convert': lambda args: bench_convert(args.books, args.width, args.height, args.repeat),
+    'pages': lambda args: bench_pages(args.books, args.width, args.height, args.samples),
+    'positions': lambda args: bench_positions(args.height),
+    'serial': lambda args: bench_serial(args.width, args.height,
+                                        args.latency / 1000.0, args.row_time / 1000.0),
+}
+
+parser = argparse.ArgumentParser(description="benchmark the canute ui")
+parser.add_argument('benchmark', nargs='?', default='convert',
+        choices=sorted(BENCHMARKS.keys()), help="what to measure")
+parser.add_argument('--books', action='store', dest='books',
+        help="directory of books to convert", default='../books/')
+parser.add_argument('--width', action='store', dest='width', type=int, default=40)
+parser.add_argument('--height', action='store', dest='height', type=int, default=9)
+parser.add_argument('--repeat', action='store', dest='repeat', type=int, default=1,
+        help="convert each book this many times and keep the fastest")
+parser.add_argument('--samples', action='store', dest='samples', type=int, default=200,
+        help="pages to fetch from each book")
+parser.add_argument('--latency', action='store', dest='latency', type=float, default=4,
+        help="milliseconds for a command or reply to get across the serial link")
+parser.add_argument('--row-time', action='store', dest='row_time', type=float, default=20,
+        help="milliseconds the firmware takes to set a row")
+parser.add_argument('--output', action='store', dest='output',
+        help="write the JSON results to this file instead of stdout")
+parser.add_argument('--baseline', action='store', dest='baseline',
+        help="JSON results of an earlier convert run to compare against")
+parser.add_argument('--tolerance', action='store', dest='tolerance', type=float,
+        default=0.1, help="fraction slower than the baseline that still passes")
+
+
+def main():
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr,
+                        format='%(message)s')
+    # keep the converters quiet
+    logging.getLogger('convert').setLevel(logging.ERROR)
+    logging.getLogger('book_format').setLevel(logging.ERROR)
+    logging.getLogger('driver').setLevel(logging.ERROR)
+    logging.getLogger('driver_pi').setLevel(logging.ERROR)
+
+    results = BENCHMARKS[args.benchmark](args)
+
+    data = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(data)
+    else:
+        print(data)
+
+    if args.baseline and args.benchmark == 'convert':
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+        if not compare(results, baseline, args.tolerance):
+            log.error('throughput regressed by more than %d%%' % (args.tolerance * 100))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,296 @@
+'''
+Book format
+===========
+
+the native book format. Version 2 files start with a fixed size header:
+
+.. code-block:: none
+
+    magic         8 bytes  'CANUTEBK'
+    version       1 byte
+    flags         1 byte   FLAG_COMPLETE once the book is fully written,
+                           FLAG_ZLIB if the pages are compressed
+    width         2 bytes  cells per row
+    height        2 bytes  rows per page
+    pages         4 bytes  number of pages, 0 until complete
+    data_offset   4 bytes  where the page data starts
+    index_offset  4 bytes  where the page index starts, 0 until complete
+    source_hash  20 bytes  sha1 of the book this was converted from, all
+                           zero if not known
+    title_length  2 bytes
+
+followed by the title (utf-8), the pages of cell bytes and then the page
+index: `pages + 1` offsets from the start of the file, the last one being the
+end of the page data. All numbers are little endian. Uncompressed pages are
+all `width * height` bytes so readers work out where they start rather than
+reading the index, which they only need for compressed books.
+
+After the page index there may be a navigation index: a count (4 bytes) and
+then for each mark the page it is on (4 bytes) and its level (1 byte), one of
+NAV_VOLUME, NAV_SECTION or NAV_HEADING, in page order. Books written before
+it was added just end after the page index.
+
+Pages are normally stored as `width * height` cell bytes. With FLAG_ZLIB set
+each page is instead a zlib compressed block preceded by its length (4 bytes),
+so a single page can be read and decompressed on its own and a book that is
+still being written can be read by stepping from block to block.
+
+Legacy files are just rows of cell bytes with no header. Cells are never more
+than 63 so the magic can't be mistaken for the start of a legacy book.
+'''
+import os
+import struct
+import binascii
+import zlib
+import logging
+log = logging.getLogger(__name__)
+
+MAGIC = 'CANUTEBK'
+VERSION = 2
+FLAG_COMPLETE = 0x01
+FLAG_ZLIB = 0x02
+# flush after the first page and then every this many pages so a book can be
+# read while it is being written
+FLUSH_PAGES = 16
+
+# levels of navigation marks
+NAV_VOLUME = 1
+NAV_SECTION = 2
+NAV_HEADING = 3
+
+header_struct = struct.Struct('<8sBBHHIII20sH')
+index_struct = struct.Struct('<I')
+nav_struct = struct.Struct('<IB')
+
+
+class BookFormatError(Exception):
+    pass
+
+
+class TruncatedHeaderError(BookFormatError):
+    '''the book is empty or has only part of a header, it is still being written'''
+    pass
+
+
+class Header(object):
+    '''the header of a version 2 native book'''
+    def __init__(self, width, height, title='', source_hash='', pages=0,
+                 flags=0, index_offset=0, version=VERSION):
+        self.version = version
+        self.flags = flags
+        self.width = width
+        self.height = height
+        self.pages = pages
+        self.index_offset = index_offset
+        self.title = title
+        self.source_hash = source_hash
+        self.data_offset = header_struct.size + len(self.title.encode('utf-8'))
+
+    @property
+    def complete(self):
+        return bool(self.flags & FLAG_COMPLETE)
+
+    @property
+    def compressed(self):
+        return bool(self.flags & FLAG_ZLIB)
+
+    @property
+    def page_bytes(self):
+        return self.width * self.height
+
+    def pack(self):
+        title = self.title.encode('utf-8')
+        source_hash = binascii.unhexlify(self.source_hash) if self.source_hash else ''
+        return header_struct.pack(MAGIC, self.version, self.flags, self.width,
+                                  self.height, self.pages, self.data_offset,
+                                  self.index_offset, source_hash, len(title)) + title
+
+
+def read_header(fh):
+    '''
+    read the header from the start of an open book
+
+    :rtype: a :class:`Header` or None for a legacy book
+    :raises TruncatedHeaderError: if the book is empty or the header is cut short
+    :raises BookFormatError: if the header is from a newer version
+    '''
+    fh.seek(0)
+    data = fh.read(header_struct.size)
+    if not MAGIC.startswith(data[:len(MAGIC)]):
+        return None
+    if len(data) < header_struct.size:
+        raise TruncatedHeaderError('truncated header')
+    (magic, version, flags, width, height, pages, data_offset, index_offset,
+     source_hash, title_length) = header_struct.unpack(data)
+    if version != VERSION:
+        raise BookFormatError('unsupported book version %d' % version)
+    title = fh.read(title_length).decode('utf-8')
+    # all 20 bytes, a sha1 can end in a zero byte
+    if source_hash == '\0' * 20:
+        source_hash = ''
+    else:
+        source_hash = binascii.hexlify(source_hash)
+    header = Header(width, height, title, source_hash, pages, flags,
+                    index_offset, version)
+    if header.data_offset != data_offset:
+        raise BookFormatError('bad data offset %d' % data_offset)
+    return header
+
+
+def read_index(data, header):
+    '''
+    :param data: the book's contents, e.g. mapped with `mmap`
+    :rtype: list of the offsets of each page and the end of the last page
+    '''
+    return list(struct.unpack_from('<%dI' % (header.pages + 1), data, header.index_offset))
+
+
+def read_navigation(data, header):
+    '''
+    :param data: the book's contents
+    :rtype: list of `(page, level)` of the navigation marks, empty if the book
+    has none
+    '''
+    offset = header.index_offset + index_struct.size * (header.pages + 1)
+    if len(data) < offset + index_struct.size:
+        return []
+    count, = index_struct.unpack_from(data, offset)
+    offset += index_struct.size
+    marks = []
+    for n in range(count):
+        marks.append(nav_struct.unpack_from(data, offset + n * nav_struct.size))
+    return marks
+
+
+def scan_blocks(data, offset):
+    '''
+    step through the compressed pages of a book that is still being written
+
+    :param data: the book's contents written so far
+    :param offset: where to start, the start of a page
+    :rtype: list of offsets of the complete pages found from `offset` and the
+    end of the last one
+    '''
+    offsets = [offset]
+    size = len(data)
+    while offset + index_struct.size <= size:
+        length, = index_struct.unpack_from(data, offset)
+        if offset + index_struct.size + length > size:
+            break
+        offset += index_struct.size + length
+        offsets.append(offset)
+    return offsets
+
+
+def read_page(data, header, offset):
+    '''
+    :param data: the book's contents
+    :rtype: the cells of the page starting at `offset`, a buffer of `data`
+    itself if the book isn't compressed
+    '''
+    if not header.compressed:
+        return buffer(data, offset, header.page_bytes)
+    length, = index_struct.unpack_from(data, offset)
+    return zlib.decompress(buffer(data, offset + index_struct.size, length))
+
+
+def open_new(filename):
+    '''
+    open a book for writing, removing any old one first rather than
+    truncating it so that readers which have it mapped keep seeing it intact
+    '''
+    if os.path.exists(filename):
+        os.remove(filename)
+    return open(filename, 'wb')
+
+
+class BookWriter(object):
+    '''
+    writes rows of pin numbers out to a native book a page at a time, padding
+    or truncating them to the display width. The header is written first
+    marked as incomplete and is rewritten along with the page index by
+    :meth:`close`.
+
+    :param fh: file handle opened for binary writing
+    :param title: unicode title of the book
+    :param source_hash: hex sha1 of the book being converted
+    :param compress: store each page zlib compressed
+    '''
+    def __init__(self, fh, width, height, title='', source_hash='', compress=False):
+        self.fh = fh
+        self.width = width
+        self.height = height
+        self.rows = 0
+        self.header = Header(width, height, title, source_hash)
+        if compress:
+            self.header.flags |= FLAG_ZLIB
+        self.fh.write(self.header.pack())
+        # rows of the page being written
+        self.page = []
+        # where each page written so far starts
+        self.offsets = []
+        self.offset = self.header.data_offset
+        # navigation marks as (page, level)
+        self.marks = []
+
+    def write_row(self, row):
+        ''':param row: a string of pin number bytes'''
+        if len(row) > self.width:
+            log.warning("length of row %d is %d which is greater than %d, truncating" % (self.rows, len(row), self.width))
+            row = row[:self.width]
+        self.page.append(row.ljust(self.width, '\0'))
+        self.rows += 1
+        if len(self.page) == self.height:
+            self._write_page()
+
+    def mark(self, level):
+        '''
+        mark the page the next row will be written on as the start of a
+        volume, section or heading. Only the highest level mark on a page is
+        kept.
+        '''
+        page = self.rows // self.height
+        if self.marks and self.marks[-1][0] == page:
+            level = min(level, self.marks[-1][1])
+            self.marks.pop()
+        self.marks.append((page, level))
+
+    def pad_page(self):
+        '''pad with empty rows up to the next page'''
+        missing = -self.rows % self.height
+        self.page.extend(['\0' * self.width] * missing)
+        self.rows += missing
+        if self.page:
+            self._write_page()
+
+    def _write_page(self):
+        data = ''.join(self.page)
+        self.page = []
+        if self.header.compressed:
+            data = zlib.compress(data)
+            data = index_struct.pack(len(data)) + data
+        self.offsets.append(self.offset)
+        self.fh.write(data)
+        self.offset += len(data)
+        pages = len(self.offsets)
+        if pages == 1 or pages % FLUSH_PAGES == 0:
+            self.fh.flush()
+
+    def close(self):
+        '''
+        pad out the last page, write the page and navigation indexes and mark
+        the book complete
+        '''
+        self.pad_page()
+        header = self.header
+        header.pages = len(self.offsets)
+        header.index_offset = self.offset
+        header.flags |= FLAG_COMPLETE
+        self.fh.write(struct.pack('<%dI' % (header.pages + 1), *(self.offsets + [self.offset])))
+        # a mark after the last row would be past the end of the book
+        marks = [mark for mark in self.marks if mark[0] < header.pages]
+        self.fh.write(index_struct.pack(len(marks)))
+        for page, level in marks:
+            self.fh.write(nav_struct.pack(page, level))
+        self.fh.seek(0)
+        self.fh.write(header.pack())
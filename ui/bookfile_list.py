@@ -1,40 +1,278 @@
+import functools
 import logging
+import mmap
 import os
-import struct
+import threading
 log = logging.getLogger(__name__)
 
+import book_format
+from book_format import BookFormatError, TruncatedHeaderError
+
+
+def _locked(method):
+    '''run `method` holding the book's lock'''
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return locked
+
 
 class BookFile_List(list):
     '''represents a file as a Python list. Only supports len and slices
 
+    opens version 2 native books, whose header gives the dimensions and size
+    of the book, as well as legacy books that are only rows of cells.
+
+    a book that is still being converted (or hasn't been created yet) can be
+    opened too. Its length is the number of rows written so far and grows as
+    the conversion continues.
+
+    the file is memory mapped the first time it is read and stays mapped
+    until :meth:`close`, or until the file is replaced, e.g. by converting the
+    book again. :meth:`get_page` and :meth:`get_rows` return buffers
+    of the mapping without copying; slices return rows as tuples of pin
+    numbers. For compressed books only the page holding the requested rows is
+    decompressed.
+
+    the reducers, the render thread, the page cache's prefetching and searches
+    all use the same books, so each method holds the book's lock while it
+    reads or changes what is known about the file.
+
     :param filename: the file to open
-    :param dimensions: display dimensions tuple
+    :param cells: number of cells in a row
+    :param height: rows in a page, checked against the book if given. Legacy
+    books don't record it so it must be given for them.
+    :param rows: number of rows of a complete book if already known, e.g. from
+    the :mod:`library_index`. The book isn't opened until it is read.
+    :param title: the title to show in the library as pin numbers
+    :raises BookFormatError: if the book was converted for other dimensions,
+    or is a legacy book and `height` isn't given
     '''
-    def __init__(self, filename, cells):
+    def __init__(self, filename, cells, height=None, rows=None, title=None):
         list.__init__(self)
         self.cells = cells
+        self.height = height
         self.filename = filename
-        statinfo = os.stat(filename)
-        self.num_pages = statinfo.st_size / self.cells
+        self.rows = rows
+        self.title = title
+        self.lock = threading.RLock()
+        self.close()
+        if rows is None:
+            self.refresh()
 
-    def __len__(self):
-        return self.num_pages
+    @_locked
+    def close(self):
+        '''
+        unmap the book and forget what was read from it, it is read afresh the
+        next time it is used
+        '''
+        self.header = None
+        self.data_offset = 0
+        self.num_pages = 0
+        self.complete = False
+        # page offsets of a compressed book, read when first needed
+        self.offsets = None
+        # the last page decompressed as (page number, cells)
+        self.page_data = (None, None)
+        # pages with navigation marks, read when first needed
+        self.nav_pages = None
+        # the mapping isn't closed explicitly as buffers handed out keep it
+        # alive, it is unmapped once they have all gone
+        self.map = None
+        self.map_inode = None
+        # inode, size and mtime of the file when it was mapped
+        self.map_stat = None
 
-    def __getslice__(self, i, j):
+    def __getstate__(self):
+        return {'filename': self.filename, 'cells': self.cells, 'height': self.height,
+                'rows': self.rows, 'title': self.title}
+
+    def __setstate__(self, state):
+        self.rows = None
+        self.title = None
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+        self.close()
+
+    def check_header(self, header):
+        '''
+        :raises BookFormatError: if the book can't be shown with our dimensions
+        '''
+        if header is None:
+            if self.height is None:
+                raise BookFormatError('%s is a legacy book, its page height is needed'
+                                      % self.filename)
+        elif header.width != self.cells or (self.height is not None and header.height != self.height):
+            raise BookFormatError('%s is %dx%d not %sx%s' % (self.filename,
+                header.width, header.height, self.cells, self.height))
+
+    @_locked
+    def refresh(self):
+        '''re-read the header and size of a book that isn't complete yet'''
+        try:
+            with open(self.filename, 'rb') as fh:
+                header = book_format.read_header(fh)
+                size = os.fstat(fh.fileno()).st_size
+        except (IOError, TruncatedHeaderError):
+            # the conversion hasn't got going yet
+            return
+        self.check_header(header)
+        if header is None:
+            self.num_pages = size / self.cells
+            self.complete = True
+            self.rows = self.num_pages
+            return
+        self.header = header
+        self.data_offset = header.data_offset
+        if header.complete:
+            self.num_pages = header.pages * header.height
+            self.complete = True
+            self.rows = self.num_pages
+            self.offsets = None
+            # map the whole of the finished book next time
+            self.map = None
+        elif header.compressed:
+            data = self.mapping()
+            if data is not None:
+                if self.offsets is None:
+                    self.offsets = [self.data_offset]
+                self.offsets += book_format.scan_blocks(data, self.offsets[-1])[1:]
+                self.num_pages = (len(self.offsets) - 1) * header.height
+        else:
+            self.num_pages = (size - self.data_offset) / self.cells
+
+    @_locked
+    def mapping(self):
+        '''
+        :rtype: the book mapped into memory, mapped again if it is still being
+        written and has grown, or None if it is empty
+        '''
+        if self.map is not None and self.complete:
+            return self.map
+        try:
+            with open(self.filename, 'rb') as fh:
+                stat = os.fstat(fh.fileno())
+                if stat.st_size == 0:
+                    return None
+                if (self.map is None or stat.st_ino != self.map_inode
+                        or stat.st_size != len(self.map)):
+                    self.map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                    self.map_inode = stat.st_ino
+                    self.map_stat = (stat.st_ino, stat.st_size, stat.st_mtime)
+        except IOError:
+            return None
+        return self.map
+
+    @_locked
+    def update(self):
+        '''
+        catch up with changes to the file: a book still being written grows
+        and a finished one is read afresh if it has been replaced
+        '''
+        if not self.complete:
+            self.refresh()
+        elif self.map_stat is not None:
+            try:
+                stat = os.stat(self.filename)
+            except OSError:
+                # gone, keep reading what we have
+                return
+            if (stat.st_ino, stat.st_size, stat.st_mtime) != self.map_stat:
+                log.info('%s has changed, reading it again' % self.filename)
+                self.close()
+                self.refresh()
+
+    @_locked
+    def page_height(self):
+        if self.header is not None:
+            return self.header.height
+        return self.height
+
+    @_locked
+    def get_page(self, page):
+        '''
+        :rtype: the cells of a page as a buffer, or None if the page hasn't
+        been written or the file has gone
+        '''
+        self.update()
+        height = self.page_height()
+        if page < 0 or (page + 1) * height > self.num_pages:
+            return None
+        data = self.mapping()
+        if data is None:
+            return None
+        if self.header is None or not self.header.compressed:
+            page_bytes = self.cells * height
+            return buffer(data, self.data_offset + page * page_bytes, page_bytes)
+        number, cells = self.page_data
+        if number != page:
+            if self.offsets is None:
+                self.offsets = book_format.read_index(data, self.header)
+            cells = book_format.read_page(data, self.header, self.offsets[page])
+            self.page_data = (page, cells)
+        return cells
+
+    @_locked
+    def navigation(self):
+        '''
+        :rtype: sorted list of the pages that start a volume, section or
+        heading, empty if the book has none or is still being written
+        '''
+        if self.nav_pages is None:
+            self.update()
+            if self.header is None or not self.header.complete:
+                return []
+            data = self.mapping()
+            if data is None:
+                return []
+            marks = book_format.read_navigation(data, self.header)
+            self.nav_pages = [page for page, level in marks]
+        return self.nav_pages
+
+    @_locked
+    def get_rows(self, i, j):
+        '''
+        :rtype: list of rows `i` to `j` as buffers of cells, rows past the end
+        of the book, or of a book whose file has gone, are blank
+        '''
         log.debug("requested lines %d to %d" % (i, j))
-        with open(self.filename) as fh:
-            pages = []
+        self.update()
+        blank = '\0' * self.cells
+        if self.header is None or not self.header.compressed:
+            data = self.mapping()
+            rows = []
             for pos in range(i, j):
-                fh.seek(pos * self.cells)
-                data = fh.read(self.cells)
-                try:
-                    page = struct.unpack("%db" % self.cells, data)
-                except struct.error:    
-                    page = [0] * self.cells
-                pages.append(page)
+                # don't read into the page index after the pages, or a file
+                # that has gone
+                if pos >= self.num_pages or pos < 0 or data is None:
+                    rows.append(blank)
+                else:
+                    rows.append(buffer(data, self.data_offset + pos * self.cells, self.cells))
+            return rows
+        height = self.page_height()
+        rows = []
+        for pos in range(i, j):
+            page, row = divmod(pos, height)
+            cells = self.get_page(page) if pos < self.num_pages else None
+            if cells is None:
+                rows.append(blank)
+            else:
+                rows.append(buffer(cells, row * self.cells, self.cells))
+        return rows
 
-        return pages
+    @_locked
+    def __len__(self):
+        if not self.complete:
+            if self.rows is not None:
+                return self.rows
+            self.refresh()
+        return self.num_pages
+
+    @_locked
+    def __getslice__(self, i, j):
+        return [tuple(bytearray(row)) for row in self.get_rows(i, j)]
 
 if __name__ == '__main__':
-    book = BookFile_List('./bookfile_list.py', 32)
+    book = BookFile_List('./bookfile_list.py', 32, 8)
     print(book[2:8])
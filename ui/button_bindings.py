@@ -18,6 +18,7 @@ button_bindings = {
             '8' : partial(actions.go_to_book, 6),
             '9' : partial(actions.go_to_book, 7),
             'L' : actions.go_to_menu,
+            'R' : actions.go_to_search,
         }
     },
     'book': {
@@ -25,9 +26,28 @@ button_bindings = {
             '1' : actions.go_to_start,
             '2' : partial(actions.skip_pages, -10),
             '3' : partial(actions.skip_pages, 10),
+            '4' : actions.previous_section,
+            '5' : actions.next_section,
             '>' : actions.next_page,
             '<' : actions.previous_page,
+            '6' : actions.go_to_search,
             'L' : actions.go_to_library,
+            'R' : actions.search_page,
+        }
+    },
+    # buttons 1 to 6 are the dots of a braille cell
+    'search': {
+        'single': {
+            '1' : partial(actions.type_dot, 1),
+            '2' : partial(actions.type_dot, 2),
+            '3' : partial(actions.type_dot, 3),
+            '4' : partial(actions.type_dot, 4),
+            '5' : partial(actions.type_dot, 5),
+            '6' : partial(actions.type_dot, 6),
+            '>' : actions.type_cell,
+            '<' : actions.delete_cell,
+            'L' : actions.go_to_library,
+            'R' : actions.search_typed,
         }
     },
     'menu': {
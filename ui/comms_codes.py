@@ -11,6 +11,9 @@ CMD_SEND_LINE    = 0x06
 CMD_RESET        = 0x07
 CMD_WARMUP       = 0x08
 
+# the first firmware version that takes a whole page with CMD_SEND_PAGE
+VERSION_SEND_PAGE = 2
+
 CMD_STATUS      = 0x02
 CMD_STATUS_OK   = 0x00
 CMD_STATUS_ERR  = 0x01
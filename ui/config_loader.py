@@ -1,4 +1,5 @@
 import os.path
+import multiprocessing
 from ConfigParser import ConfigParser
 
 config_file = 'config.rc'
@@ -7,8 +8,26 @@ def load (config_file = config_file):
     config.read(config_file)
     library_dir = config.get('files', 'library_dir')
     config.set('files', 'library_dir', os.path.expanduser(library_dir))
+    # defaults are strings like the options read from the file, getint and
+    # friends can't interpolate anything else
     if not config.has_section('comms'):
         config.add_section('comms')
     if not config.has_option('comms', 'timeout'):
-        config.set('comms', 'timeout', 60)
+        config.set('comms', 'timeout', '60')
+    if not config.has_option('comms', 'window'):
+        config.set('comms', 'window', '4')
+    if not config.has_section('conversion'):
+        config.add_section('conversion')
+    if not config.has_option('conversion', 'workers'):
+        config.set('conversion', 'workers', str(multiprocessing.cpu_count()))
+    if not config.has_option('conversion', 'compress'):
+        config.set('conversion', 'compress', 'no')
+    if not config.has_section('cache'):
+        config.add_section('cache')
+    if not config.has_option('cache', 'size'):
+        config.set('cache', 'size', str(256 * 1024))
+    if not config.has_section('state'):
+        config.add_section('state')
+    if not config.has_option('state', 'write_interval'):
+        config.set('state', 'write_interval', '2')
     return config
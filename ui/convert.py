@@ -1,122 +1,328 @@
 import logging
 log = logging.getLogger(__name__)
 import os
-import xml.dom.minidom as minidom
+import re
+import textwrap
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
 
 import utility
+import book_format
+import search
+from book_format import BookWriter
 
-def convert_brf(width, height, brf_file, native_file, remove=True):
+# bump this whenever the native output of the converters changes so that
+# cached conversions are redone
+CONVERTER_VERSION = 4
+
+BRF_CHUNK_SIZE = 64 * 1024
+# line feeds end a row, form feeds end a row and a page
+_brf_breaks = re.compile('([\n\f])')
+# longest line read from a text file at once, longer lines are split
+TXT_LINE_LIMIT = 64 * 1024
+# extensions of the books convert_book converts, lower case
+CONVERT_EXTENSIONS = ('pef', 'brf', 'txt')
+
+
+def book_title(native_file):
+    '''the title stored in the header of a native book, from its filename'''
+    basename = os.path.basename(native_file)
+    title = os.path.splitext(basename)[0].replace('_', ' ')
+    return title.decode('utf-8', 'replace')
+
+
+def convert_brf(width, height, brf_file, native_file, remove=True, source_hash=None,
+                compress=False):
     '''
     converts a brf format braille book to native.
 
+    the brf is streamed through in chunks of :data:`BRF_CHUNK_SIZE` and each
+    chunk is translated to pin numbers in one go with
+    :data:`utility.alpha_to_pin_table`, so memory use doesn't depend on the
+    size of the book. empty lines are skipped and form feeds pad up to the
+    next page. short centred lines at the top of a page or after a blank line
+    are marked as headings in the navigation index.
+
     :param brf: filename of the pef file
     :param native_file: filename of the destination file
+    :param source_hash: sha1 of the brf if already known
+    :param compress: store the pages compressed
     '''
     log.info("converting brf %s" % brf_file)
+    if source_hash is None:
+        source_hash = utility.file_hash(brf_file)
 
+    unknown = 0
+    with open(brf_file, 'rb') as src, book_format.open_new(native_file) as dst:
+        writer = BookWriter(dst, width, height, book_title(native_file), source_hash,
+                            compress)
+        # the part of a line carried over from the previous chunk
+        line = ''
+        # whether the last row written was blank, headings follow one
+        blank = True
+        while True:
+            chunk = src.read(BRF_CHUNK_SIZE)
+            if not chunk:
+                break
+            parts = _brf_breaks.split(line + chunk)
+            # the last part has no line ending yet so wait for the next chunk
+            line = parts.pop()
+            for part in parts:
+                if part == '\n':
+                    continue
+                elif part == '\f':
+                    writer.pad_page()
+                elif part:
+                    unknown += len(part.translate(None, utility.alpha_table_chars))
+                    if (blank or writer.rows % height == 0) and _is_heading(part, width):
+                        writer.mark(book_format.NAV_HEADING)
+                    blank = part.strip() == ''
+                    writer.write_row(part.translate(utility.alpha_to_pin_table))
+                else:
+                    # an empty line, which is skipped
+                    blank = True
+        if line:
+            unknown += len(line.translate(None, utility.alpha_table_chars))
+            if (blank or writer.rows % height == 0) and _is_heading(line, width):
+                writer.mark(book_format.NAV_HEADING)
+            writer.write_row(line.translate(utility.alpha_to_pin_table))
+        writer.close()
 
-    def pad_line(converted):
-        converted.extend([0] * (width - len(converted)))
-
-    # do the conversion from brf to pin numbers
-    book = []
-    with open(brf_file) as fh:
-        for line in fh.readlines():
-            converted = []
-            for char in line:
-                try:
-                    converted.append(utility.alpha_to_pin_num(char))
-                except utility.LinefeedConversionException:
-                    if len(converted):
-                        pad_line(converted)
-                        book.append(converted)
-                        converted = []
-                except utility.FormfeedConversionException:
-                    if len(converted):
-                        pad_line(converted)
-                        book.append(converted)
-                        converted = []
-
-                    # pad up to the next page
-                    while len(book) % height != 0:
-                        book.append([0] * width)
-
-            if len(converted):
-                pad_line(converted)
-                book.append(converted)
-
-    log.info("brf loaded with %d lines" % len(book))
-    log.info("writing to [%s]" % native_file)
-    with open(native_file, 'w') as fh:
-        for index,line in enumerate(book):
-            if len(line) > width:
-                log.warning("length of row %d is %d which is greater than %d, truncating" % (index, len(line), width))
-            fh.write(bytearray(line[:width]))
+    if unknown:
+        log.warning("%d characters in %s could not be converted, used blank cells" % (unknown, brf_file))
+    log.info("brf converted to %d lines in [%s]" % (writer.rows, native_file))
 
     if remove:
         log.info("removing old brf file")
         os.remove(brf_file)
 
-def convert_pef(width, height, pef_file, native_file, remove=True):
+def convert_txt(width, height, txt_file, native_file, remove=True, source_hash=None,
+                compress=False):
+    '''
+    converts a plain text file to native. The text is read as braille ascii,
+    the same as :func:`utility.alphas_to_pin_nums`, a line at a time and word
+    wrapped to the display width. Blank lines are kept and form feeds start a
+    new page.
+
+    :param txt_file: filename of the text file
+    :param native_file: filename of the destination file
+    :param source_hash: sha1 of the text file if already known
+    :param compress: store the pages compressed
+    '''
+    log.info("converting txt %s" % txt_file)
+    if source_hash is None:
+        source_hash = utility.file_hash(txt_file)
+
+    unknown = 0
+    with open(txt_file, 'rb') as src, book_format.open_new(native_file) as dst:
+        writer = BookWriter(dst, width, height, book_title(native_file), source_hash,
+                            compress)
+        for line in iter(lambda: src.readline(TXT_LINE_LIMIT), ''):
+            pieces = line.rstrip('\r\n').split('\f')
+            for n, text in enumerate(pieces):
+                if n > 0:
+                    writer.pad_page()
+                # a form feed on its own doesn't make a blank row
+                if text == '' and len(pieces) > 1:
+                    continue
+                for row in textwrap.wrap(text, width) or ['']:
+                    unknown += len(row.translate(None, utility.alpha_table_chars))
+                    writer.write_row(row.translate(utility.alpha_to_pin_table))
+        writer.close()
+
+    if unknown:
+        log.warning("%d characters in %s could not be converted, used blank cells" % (unknown, txt_file))
+    log.info("txt converted to %d lines in [%s]" % (writer.rows, native_file))
+
+    if remove:
+        log.info("removing old txt file")
+        os.remove(txt_file)
+
+
+def convert_book(width, height, book_file, native_file, remove=True, source_hash=None,
+                 compress=False):
+    '''
+    converts a pef, brf or txt book to native, picking the converter from the
+    file extension
+
+    :param book_file: filename of the pef, brf or txt file
+    :param native_file: filename of the destination file
+    :param source_hash: sha1 of the book if already known
+    :param compress: store the pages compressed
+    :rtype: the native filename or None if the book isn't a format we convert
+        or couldn't be converted
+    '''
+    ext = extension(book_file)
+    if ext == 'pef':
+        if not convert_pef(width, height, book_file, native_file, remove, source_hash,
+                           compress):
+            return None
+    elif ext == 'brf':
+        convert_brf(width, height, book_file, native_file, remove, source_hash, compress)
+    elif ext == 'txt':
+        convert_txt(width, height, book_file, native_file, remove, source_hash, compress)
+    else:
+        return None
+    return native_file
+
+
+def extension(book_file):
+    ''':rtype: the extension of a book in lower case, without the dot'''
+    return os.path.splitext(book_file)[1][1:].lower()
+
+
+def can_convert(book_file):
+    ''':rtype: True if :func:`convert_book` converts books like `book_file`'''
+    return extension(book_file) in CONVERT_EXTENSIONS
+
+
+def source_key(book_file, width, height, compress=False):
+    '''
+    the key a conversion is cached under: the content hash of the source
+    book, the display dimensions, the converter version and whether the pages
+    are compressed
+    '''
+    key = '%s-%dx%d-v%d' % (utility.file_hash(book_file), width, height, CONVERTER_VERSION)
+    if compress:
+        key += '-z'
+    return key
+
+
+def key_hash(key):
+    '''the source hash part of a key from :func:`source_key`'''
+    return key.split('-', 1)[0]
+
+
+def convert_job(job):
+    '''
+    runs :func:`convert_book` with a tuple of `(width, height, book_file,
+    native_file, cached_key, compress)`, for use with
+    `multiprocessing.Pool.map`.
+
+    if the source book still matches the `cached_key` the native file was
+    converted from, the existing native file is kept and the book is only
+    removed. A newly converted book is indexed for :mod:`search`. Errors
+    are logged rather than raised so one bad book doesn't stop the rest of
+    the library converting.
+
+    :rtype: tuple of native filename and source key or None on failure
+    '''
+    width, height, book_file, native_file, cached_key, compress = job
+    try:
+        key = source_key(book_file, width, height, compress)
+        if key == cached_key and os.path.exists(native_file):
+            log.info("%s is already converted, removing it" % book_file)
+            os.remove(book_file)
+        elif convert_book(width, height, book_file, native_file,
+                          source_hash=key_hash(key), compress=compress) is None:
+            return None
+        else:
+            try:
+                search.write_index(native_file, width, height)
+            except (IOError, OSError) as e:
+                log.warning("could not index %s for search: %s" % (native_file, e))
+        return (native_file, key)
+    except Exception as e:
+        log.error("could not convert %s: %s" % (book_file, e))
+        return None
+
+
+def convert_pef(width, height, pef_file, native_file, remove=True, source_hash=None,
+                compress=False):
     '''
     converts a pef format braille book (XML) to native.
     This format uses unicode of braille and uses the
-    `unicode_to_pin_num()` function for the conversion to our own numbered
+    `unicodes_to_pin_nums()` function to convert each row to our own numbered
     braille pictures.
 
+    the xml is parsed incrementally and each page is written out and then
+    discarded as soon as its closing tag is read, so memory use is bounded by
+    the size of a page rather than the book.
+
     :param pef_file: filename of the pef file
     :param native_file: filename of the destination file
+    :param source_hash: sha1 of the pef if already known
+    :param compress: store the pages compressed
+    :rtype: False if the pef couldn't be converted, the error is logged and
+        no native file is left behind
     '''
     log.info("converting pef %s" % pef_file)
+    if source_hash is None:
+        source_hash = utility.file_hash(pef_file)
+
+    invalid = 0
     try:
-        xml_doc = minidom.parse(pef_file)
-    except:
-        log.error("could not convert %s" % pef_file)
+        with book_format.open_new(native_file) as fh:
+            writer = BookWriter(fh, width, height, book_title(native_file), source_hash,
+                                compress)
+            pages = 0
+            page_rows = 0
+            # elements that have been opened but not closed yet
+            parents = []
+            for event, elem in ElementTree.iterparse(pef_file, ('start', 'end')):
+                if event == 'start':
+                    parents.append(elem)
+                    tag = _local_name(elem.tag)
+                    if tag == 'volume':
+                        writer.mark(book_format.NAV_VOLUME)
+                    elif tag == 'section':
+                        writer.mark(book_format.NAV_SECTION)
+                    continue
+                parents.pop()
+                tag = _local_name(elem.tag)
+                if tag == 'row':
+                    data = (elem.text or '').rstrip()
+                    line, row_invalid = utility.unicodes_to_pin_nums(data)
+                    invalid += row_invalid
+                    writer.write_row(line)
+                    page_rows += 1
+                elif tag == 'page':
+                    # pad missing rows
+                    for _ in range(height - page_rows):
+                        writer.write_row('')
+                    page_rows = 0
+                    pages += 1
+                    # we are done with this page and any before it
+                    elem.clear()
+                    if parents:
+                        del parents[-1][:]
+            writer.close()
+    except Exception as e:
+        log.error("could not convert %s: %s" % (pef_file, e))
+        # the native file won't be there if it couldn't be opened
+        if os.path.exists(native_file):
+            os.remove(native_file)
         if remove:
             os.remove(pef_file)
-        return
-
-    pages = xml_doc.getElementsByTagName('page')
-    log.debug("got %d pages" % len(pages))
-    lines = []
-
-    def pad_page(page):
-        num_rows = len(page.getElementsByTagName('row'))
-        for i in range(height - num_rows):
-            blank_row = xml_doc.createElement("row")
-            txt = xml_doc.createTextNode("")
-            blank_row.appendChild(txt)
-            page.appendChild(blank_row)
-
-    #rows do the conversion from unicode to pin numbers
-    for page in pages:
-        # pad missing rows
-        pad_page(page)
-        for row in page.getElementsByTagName('row'):
-            try:
-                data = row.childNodes[0].data.rstrip()
-                line = []
-                for uni_char in data:
-                    pin_num = utility.unicode_to_pin_num(uni_char)
-                    line.append(pin_num)
-            except IndexError:
-                # empty row element
-                line = [0] * width
-
-            # ensure right length
-            missing_cells = width - len(line)
-            line.extend([0] * missing_cells)
-
-            lines.append(line)
-
-    log.info("pef loaded with %d lines" % len(lines))
-    log.info("writing to [%s]" % native_file)
-    with open(native_file, 'w') as fh:
-        for index,line in enumerate(lines):
-            if len(line) > width:
-                log.warning("length of row %d is %d which is greater than %d, truncating" % (index, len(line), width))
-            fh.write(bytearray(line[:width]))
+        return False
+
+    if invalid:
+        log.warning("%d characters in %s were not 6 dot braille, used blank cells" % (invalid, pef_file))
+    log.debug("got %d pages" % pages)
+    log.info("pef converted to %d lines in [%s]" % (writer.rows, native_file))
 
     if remove:
         log.info("removing old pef file")
         os.remove(pef_file)
+    return True
+
+
+def _is_heading(line, width):
+    '''
+    a brf line is taken to be a heading if it is a short line centred on the
+    page. Paragraphs start with a two space indent and fill the line, so
+    they are never taken for one.
+    '''
+    text = line.rstrip()
+    content = text.lstrip(' ')
+    left = len(text) - len(content)
+    right = width - len(text)
+    return (content != '' and left >= 3 and len(content) <= width - 8
+            and abs(left - right) <= 2)
+
+
+def _local_name(tag):
+    '''strip the namespace from an ElementTree tag'''
+    return tag.rsplit('}', 1)[-1]
@@ -2,6 +2,7 @@ import logging
 log = logging.getLogger(__name__)
 from comms_codes import *
 import abc
+import collections
 import utility
 
 class DriverError(Exception):
@@ -10,15 +11,50 @@ class DriverError(Exception):
 
 class Driver(object):
     '''Abstract base class of the braille device's capabilities.
+
+    keeps a shadow copy of what each row of the display is showing so that
+    rows that wouldn't change aren't sent again, see :meth:`set_braille_row`.
+
+    up to `window` rows are sent before waiting for the status of the first,
+    so the display always has the next row to hand instead of waiting a round
+    trip for it. The statuses come back in the order the rows were sent. Call
+    :meth:`flush` to wait for all of them. After an error it sends one row at
+    a time until a whole page gets through without one.
+
+    firmware that is new enough takes a whole page in one command instead,
+    see :meth:`set_page`.
+
+    :param window: most rows to have sent without their status back
     '''
 
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self):
+    def __init__(self, window=1):
         self.status = 0
+        self.window = max(1, window)
+        # (row, cells) of the rows sent that haven't had their status back yet
+        self.in_flight = collections.deque()
+        self.stop_and_wait = False
+        # errors since the last flush
+        self.errors = 0
         (self.chars, self.rows) = self.get_dimensions()
+        self.version = self.get_version()
+        self.send_pages = self.version >= VERSION_SEND_PAGE
         self.page_length = self.rows * self.chars
-        log.info("device ready with %d x %d characters" % (self.chars, self.rows))
+        self.rows_sent = 0
+        self.rows_skipped = 0
+        self.invalidate()
+        log.info("device ready with %d x %d characters, firmware version %d" %
+                 (self.chars, self.rows, self.version))
+
+    def invalidate(self):
+        '''forget what the display is showing so every row is sent next time'''
+        # the cells of each row as a string, None if not known
+        self.shadow = [None] * self.rows
+
+    def row_stats(self):
+        ''':rtype: dict of the number of rows sent and skipped as unchanged'''
+        return {'sent': self.rows_sent, 'skipped': self.rows_skipped}
 
     @abc.abstractmethod
     def is_ok(self):
@@ -46,10 +82,14 @@ class Driver(object):
         return
 
     def reset_display(self):
+        self.flush()
+        self.invalidate()
         self.send_data(CMD_RESET)
         return self.get_data(CMD_RESET)
 
     def warm_up(self):
+        self.flush()
+        self.invalidate()
         self.send_data(CMD_WARMUP)
         return self.get_data(CMD_WARMUP)
 
@@ -60,12 +100,21 @@ class Driver(object):
         :rtype: a tuple containing 2 integers: number of cells and number of
         rows
         '''
+        self.flush()
         self.send_data(CMD_GET_CHARS)
         chars = self.get_data(CMD_GET_CHARS)
         self.send_data(CMD_GET_ROWS)
         rows = self.get_data(CMD_GET_ROWS)
         return (chars, rows)
 
+    def get_version(self):
+        '''
+        :rtype: the firmware version, see :data:`VERSION_SEND_PAGE`
+        '''
+        self.flush()
+        self.send_data(CMD_SEND_VERSION)
+        return self.get_data(CMD_SEND_VERSION)
+
     def get_page_length(self):
         '''
         returns length of data required to fill a full page
@@ -75,6 +124,7 @@ class Driver(object):
         return self.page_length
 
     def clear_page(self):
+        self.invalidate()
         data = [0] * self.page_length
         self.set_braille(data)
 
@@ -128,21 +178,103 @@ class Driver(object):
 
         log.debug("setting page of braille:")
 
+        rows = [data[row*self.chars:row*self.chars+self.chars] for row in range(self.rows)]
+        self.set_page(rows)
+
+    def set_page(self, rows, stale=None):
+        '''
+        send a page to the display. Firmware that takes whole pages gets it in
+        one command, which is only sent if a row has changed. Otherwise the
+        rows are sent with :meth:`set_braille_row`.
+
+        :param rows: the cells of each row, as for :meth:`set_braille_row`
+        :param stale: function called between rows, returns True to give up
+        on the rest of the page
+        :rtype: False if `stale` stopped it before all the rows were sent
+        '''
+        if not self.send_pages:
+            for row, data in enumerate(rows):
+                if stale is not None and stale():
+                    return False
+                self.set_braille_row(row, data)
+            self.flush()
+            return True
+
+        page = []
         for row in range(self.rows):
-            row_braille = data[row*self.chars:row*self.chars+self.chars]
-            self.set_braille_row(row, row_braille)
+            data = bytearray(rows[row]) if row < len(rows) else bytearray()
+            data = data[0:self.chars]
+            page.append(str(data + bytearray(self.chars - len(data))))
+        changed = len([row for row in range(self.rows) if page[row] != self.shadow[row]])
+        self.rows_skipped += self.rows - changed
+        if changed == 0:
+            log.debug("page unchanged, not sending it")
+            return True
+
+        self.flush()
+        self.send_data(CMD_SEND_PAGE, list(bytearray(''.join(page))))
+        self.rows_sent += changed
+        self.status = self.get_data(CMD_SEND_PAGE)
+        if self.status != 0:
+            log.warning("got an error after setting a page of braille: %d" % self.status)
+            self.invalidate()
+        else:
+            self.shadow = page
+        return True
 
     def set_braille_row(self, row, data):
+        '''
+        send a row to the display unless the shadow copy says it is already
+        showing it. Its status may not have come back when this returns, see
+        :meth:`flush`.
+
+        :param data: the cells of the row as a sequence of pin numbers or a
+        string/buffer of pin number bytes
+        '''
+        data = bytearray(data)
         if len(data) > self.chars:
             log.warning("row data too long, length %d, truncating to %d" % (len(data), self.chars))
             data = data[0:self.chars]
 
+        cells = str(data)
+        if self.shadow[row] == cells:
+            self.rows_skipped += 1
+            log.debug("row %i unchanged, not sending it" % row)
+            return
+
         log.debug("setting row of braille:")
         log.debug("row %i: |%s|" % (row, '|'.join(map(utility.pin_num_to_unicode, data))))
 
         self.send_data(CMD_SEND_LINE, [row] + list(data))
-
-        # get status
+        self.rows_sent += 1
+        # receive_status forgets it again if it fails
+        self.shadow[row] = cells
+        self.in_flight.append((row, cells))
+
+        window = 1 if self.stop_and_wait else self.window
+        while len(self.in_flight) >= window:
+            self.receive_status()
+
+    def receive_status(self):
+        '''get the status of the oldest row still waiting for one'''
+        row, cells = self.in_flight.popleft()
         self.status = self.get_data(CMD_SEND_LINE)
         if self.status != 0:
             log.warning("got an error after setting braille: %d" % self.status)
+            self.errors += 1
+            # unless it has been sent again since
+            if self.shadow[row] == cells:
+                self.shadow[row] = None
+            if self.window > 1 and not self.stop_and_wait:
+                log.warning("sending one row at a time")
+                self.stop_and_wait = True
+
+    def flush(self):
+        '''wait for the status of every row that has been sent'''
+        while self.in_flight:
+            self.receive_status()
+        if self.stop_and_wait and self.errors == 0:
+            log.info("sending %d rows at a time again" % self.window)
+            self.stop_and_wait = False
+        # errors since the last flush
+        self.errors = 0
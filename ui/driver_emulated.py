@@ -15,6 +15,7 @@ class Emulated(Driver):
     BUTTONS = 9
     CHARS = 40
     ROWS = 9
+    VERSION = VERSION_SEND_PAGE
 
     """driver class that emulates the machine with a GUI
 
@@ -94,6 +95,8 @@ class Emulated(Driver):
             self.data = Emulated.CHARS
         elif cmd == CMD_GET_ROWS:
             self.data = Emulated.ROWS
+        elif cmd == CMD_SEND_VERSION:
+            self.data = Emulated.VERSION
         elif cmd == CMD_SEND_PAGE:
             self.data = 0
             log.debug("received data for emulator %s" % data)
@@ -14,6 +14,10 @@ log = logging.getLogger(__name__)
 long_press   = 500.0 #ms
 double_click = 200.0 #ms
 debounce     = 20 #ms
+# how long get_buttons waits for a press
+BUTTON_WAIT  = 0.1 #s
+# how long to wait for the firmware version, older firmware doesn't answer
+VERSION_TIMEOUT = 0.5 #s
 
 try:
     import evdev
@@ -29,8 +33,9 @@ class Pi(Driver):
 
     :param port: the serial port the display is plugged into
     :param pi_buttons: whether to use the evdev input for button presses
+    :param window: most rows to send before waiting for their status
     """
-    def __init__(self, port='/dev/ttyACM0', pi_buttons=False, timeout=60):
+    def __init__(self, port='/dev/ttyACM0', pi_buttons=False, timeout=60, window=1):
         self.timeout = timeout
         # get serial connection
         if port:
@@ -39,7 +44,7 @@ class Pi(Driver):
         else:
             self.port = None
 
-        super(Pi, self).__init__()
+        super(Pi, self).__init__(window)
 
         if pi_buttons:
             self.button_queue = Queue.Queue()
@@ -100,9 +105,14 @@ class Pi(Driver):
         '''
         buttons = {}
         if hasattr(self, 'button_queue'):
-            for _ in range(100):
+            for n in range(100):
                 try:
-                    event = self.button_queue.get_nowait()
+                    # wait a little for the first press so that the button
+                    # loop doesn't spin and starve the render thread
+                    if n == 0:
+                        event = self.button_queue.get(timeout = BUTTON_WAIT)
+                    else:
+                        event = self.button_queue.get_nowait()
                 except Queue.Empty:
                     event = None
                 if event is not None and (event.type == evdev.ecodes.EV_KEY) and (event.value == evdev.KeyEvent.key_down):
@@ -133,6 +143,8 @@ class Pi(Driver):
                         buttons['L'] = 'single'
                     elif (event.code == e.KEY_R):
                         buttons['R'] = 'single'
+        else:
+            time.sleep(BUTTON_WAIT)
         return buttons
 
     def send_error_sound(self):
@@ -155,6 +167,30 @@ class Pi(Driver):
         log.debug("tx cmd [%s]" % binascii.hexlify(message))
         self.port.write(message)
 
+    def get_version(self):
+        '''
+        ask the firmware its version, not waiting long as older firmware
+        doesn't know the command
+
+        :rtype: the version, 0 if there was no answer
+        '''
+        self.flush()
+        timeout = self.port.timeout
+        self.port.timeout = VERSION_TIMEOUT
+        try:
+            self.send_data(CMD_SEND_VERSION)
+            message = self.port.read(2)
+        finally:
+            self.port.timeout = timeout
+        log.debug("rx [%s]" % binascii.hexlify(message))
+        if len(message) != 2 or struct.unpack('2b', message)[0] != CMD_SEND_VERSION:
+            log.info("firmware didn't give its version, sending a row at a time")
+            # in case something turns up late
+            time.sleep(VERSION_TIMEOUT)
+            self.port.flushInput()
+            return 0
+        return struct.unpack('2b', message)[1]
+
     def get_data(self, expected_cmd):
         '''gets 2 bytes of data from the hardware
 
@@ -1,11 +1,16 @@
 from frozendict import frozendict
 from functools import partial
+import os
+import json
 import pickle
+import threading
+import time
 import logging
 log = logging.getLogger(__name__)
 
 import utility
 import menu
+from persistent_map import PersistentMap
 
 
 initial_state = frozendict({
@@ -16,6 +21,8 @@ initial_state = frozendict({
         'page': 0
     }),
     'books'             : tuple(),
+    # the filename of each book in 'books', which are kept in this order
+    'filenames'         : tuple(),
     'replacing_library' : False,
     'backing_up_log'    : False,
     'shutting_down'     : False,
@@ -23,40 +30,174 @@ initial_state = frozendict({
     'warming_up'        : False,
     'resetting_display' : False,
     'update_ui'         : False,
+    # a search is for the words of query, or the first row of page as
+    # (filename, page) if it is set. typed is the pin numbers of the cells
+    # typed for a new query and cell the one being typed
+    'search'            : frozendict({'query': (), 'page': None, 'searching': False,
+                                      'results': (), 'result': 0,
+                                      'typed': (), 'cell': 0}),
     'display'           : frozendict({'width': 40, 'height': 9}),
+    # filename to the page each book is open at, if it isn't the first
+    'positions'         : PersistentMap(),
+    # filename to the pages that start a section of each book that has been
+    # opened, see actions.set_navigation
+    'navigation'        : PersistentMap(),
 })
 
-state_file = 'state.pkl'
+state_file = 'state.json'
+# the pickled state written by earlier versions
+legacy_state_file = 'state.pkl'
+STATE_VERSION = 3
 
-def read(state_file = state_file):
+
+def migrate_1(saved):
+    '''the pickled state of version 1 to version 2'''
+    location = saved.get('location', 'library')
+    books = saved.get('books', ())
+    if type(location) == int:
+        location = books[location]['data'].filename if location < len(books) else 'library'
+    elif location != 'library':
+        location = 'library'
+    return {
+        'version'   : 2,
+        'location'  : location,
+        'update_ui' : saved.get('update_ui', False),
+        'pages'     : dict((b['data'].filename, b['page']) for b in books if b['page']),
+    }
+
+
+def migrate_2(saved):
+    '''
+    version 2 to version 3, which stores filenames with
+    :func:`utility.filename_to_json` rather than as utf-8
+    '''
+    def filename(name):
+        if isinstance(name, unicode):
+            return name.encode('utf-8')
+        return name
+    return dict(saved,
+        version  = 3,
+        location = filename(saved['location']),
+        pages    = dict((filename(name), page) for name, page in saved['pages'].items()),
+    )
+
+
+# functions that take a saved state of the version they're keyed by to the
+# next version
+migrations = {1: migrate_1, 2: migrate_2}
+
+
+def _filename(name):
+    if isinstance(name, unicode):
+        return utility.filename_from_json(name)
+    return name
+
+
+def read(state_file = state_file, legacy_state_file = legacy_state_file):
+    '''
+    read the saved state. Only the position in each book, the book being read
+    and the flags that outlast a restart are saved, the books themselves are
+    added by `main.sync_library`.
+
+    :rtype: the state to start with, the hard-coded initial state if there
+    is no saved state or it can't be read
+    '''
     log.debug('reading initial state from %s' % state_file)
     try:
-        with open(state_file) as fh:
-            state = pickle.load(fh)
-            return state
-    except:
-        log.debug('error reading state file, using hard-coded initial state')
+        try:
+            with open(state_file) as fh:
+                saved = json.load(fh)
+        except IOError:
+            with open(legacy_state_file, 'rb') as fh:
+                saved = dict(pickle.load(fh), version = 1)
+            log.info('migrating state from %s' % legacy_state_file)
+        while saved['version'] < STATE_VERSION:
+            saved = migrations[saved['version']](saved)
+        if saved['version'] != STATE_VERSION:
+            raise ValueError('unknown state version %s' % saved['version'])
+        # filenames are byte strings, as they are found on disk
+        location = _filename(saved['location'])
+        if location != 'library' and not os.path.exists(location):
+            location = 'library'
+        pages = ((_filename(filename), page) for filename, page in saved['pages'].items())
+        return initial_state.copy(location = location, update_ui = saved['update_ui'],
+                                  positions = PersistentMap(pages))
+    except Exception as e:
+        log.debug('error reading state file ({}), using hard-coded initial state'.format(e))
         return initial_state
 
 
-def write(state):
+def write(state, state_file = state_file):
     log.debug('writing state file')
-    write_state                      = dict(state)
-    write_state['library']           = state['library'].copy(page = 0)
     location = state['location']
-    if location == 'menu':
+    if type(location) == int:
+        location = state['filenames'][location]
+    elif location in ('menu', 'search'):
         location = 'library'
-    write_state['location']          = location
-    write_state['backing_up_log']    = False
-    write_state['replacing_library'] = False
-    write_state['resetting_display'] = False
-    write_state['warming_up']        = False
-    write_state['shutting_down']     = False
-    with open(state_file, 'w') as fh:
-        pickle.dump(frozendict(write_state), fh)
+    pages = dict((utility.filename_to_json(filename), page)
+                 for filename, page in state['positions'].items() if page)
+    data = json.dumps({
+        'version'   : STATE_VERSION,
+        'location'  : utility.filename_to_json(location),
+        'update_ui' : state['update_ui'],
+        'pages'     : pages,
+    })
+    utility.write_atomically(state_file, data)
+
+
+class StateWriter(object):
+    '''
+    saves the state on a background thread so that changing it never waits
+    on the SD card. Changes within `interval` seconds of each other are saved
+    together, as only the latest state is kept. Call :meth:`flush` to save it
+    straight away, e.g. before shutting down.
+    '''
+    def __init__(self, interval = 2, state_file = state_file):
+        self.interval = interval
+        self.state_file = state_file
+        self.pending = None
+        self.writes = 0
+        # guards pending
+        self.lock = threading.Lock()
+        # only one write at a time
+        self.write_lock = threading.Lock()
+        self.changed = threading.Event()
+        self.thread = None
+
+    def schedule(self, state):
+        '''save `state` soon, unless a newer one is scheduled first'''
+        with self.lock:
+            self.pending = state
+        if self.thread is None:
+            self.thread = threading.Thread(target = self.run)
+            self.thread.daemon = True
+            self.thread.start()
+        self.changed.set()
+
+    def run(self):
+        while True:
+            self.changed.wait()
+            # wait for any more changes to come in
+            time.sleep(self.interval)
+            self.changed.clear()
+            self.flush()
+
+    def flush(self):
+        '''save the latest scheduled state now if it hasn't been already'''
+        with self.write_lock:
+            with self.lock:
+                state, self.pending = self.pending, None
+            if state is not None:
+                try:
+                    write(state, self.state_file)
+                    self.writes += 1
+                except (IOError, OSError, ValueError) as e:
+                    # ValueError includes the UnicodeErrors of a state that
+                    # can't be stored, which mustn't stop later ones being saved
+                    log.error('could not write state file: {}'.format(e))
 
 if __name__ == '__main__':
-    import os
     path = os.path.abspath(__file__)
     dir_path = os.path.dirname(path)
-    print(read(state_file = dir_path + "/state.pkl")['update_ui'])
+    print(read(state_file = dir_path + "/" + state_file,
+               legacy_state_file = dir_path + "/" + legacy_state_file)['update_ui'])
@@ -0,0 +1,175 @@
+'''
+Library index
+=============
+
+records what is in the library so that starting up with a big library
+doesn't have to list every directory and open every book. For each directory
+it keeps its mtime and what was in it, and for each complete native book its
+size, mtime, dimensions, number of rows and title.
+
+a directory whose mtime hasn't changed can't have had books added, removed or
+replaced, so its listing and the books in it are taken from the index. Only
+directories that have changed are listed and only the books in them are
+looked at again.
+
+the index is kept in the ui directory alongside the state file rather than in
+the library, as writing it there would change the library directory's mtime.
+Books taken from the index aren't opened at all, so a book rewritten for other
+dimensions without its directory changing is only found when it is first read.
+'''
+import os
+import re
+import json
+import logging
+log = logging.getLogger(__name__)
+
+import utility
+from bookfile_list import BookFile_List
+
+index_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'library.json')
+# version 2 stores filenames with utility.filename_to_json
+INDEX_VERSION = 2
+
+
+def title(filename):
+    ''':rtype: the title shown in the library for a book, as pin numbers'''
+    basename = os.path.basename(filename)
+    return utility.alphas_to_pin_nums(os.path.splitext(basename)[0].replace('_', ' '))
+
+
+class LibraryIndex(object):
+    '''
+    the index of a library, read from `index_file` if there is a usable one
+    for `library_dir`. Call :meth:`write` to save any changes.
+    '''
+    def __init__(self, library_dir, index_file=index_file):
+        self.library_dir = library_dir
+        self.index_file = index_file
+        self.dirs = {}
+        self.books = {}
+        # directories found to have changed by find_files
+        self.changed_dirs = set()
+        self.changed = False
+        try:
+            with open(index_file) as fh:
+                index = json.load(fh)
+            if index['version'] != INDEX_VERSION:
+                log.info('ignoring library index version %s' % index['version'])
+                return
+            if utility.filename_from_json(index['library_dir']) != library_dir:
+                log.info('ignoring library index of %s' % index['library_dir'])
+                return
+            from_json = utility.filename_from_json
+            self.dirs = dict((from_json(name), {'mtime': entry['mtime'],
+                                                'files': map(from_json, entry['files']),
+                                                'dirs': map(from_json, entry['dirs'])})
+                             for name, entry in index['dirs'].items())
+            self.books = dict((from_json(name), entry)
+                              for name, entry in index['books'].items())
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            log.debug('no usable library index in %s: %s' % (library_dir, e))
+
+    def relpath(self, path):
+        return os.path.relpath(path, self.library_dir)
+
+    def listing(self, directory):
+        '''
+        :rtype: tuple of the files and directories in `directory`, from the
+        index if it hasn't changed
+        '''
+        name = self.relpath(directory)
+        mtime = os.stat(directory).st_mtime
+        entry = self.dirs.get(name)
+        if entry is None or entry['mtime'] != mtime:
+            files = []
+            dirs = []
+            for child in sorted(os.listdir(directory)):
+                if os.path.isdir(os.path.join(directory, child)):
+                    dirs.append(child)
+                else:
+                    files.append(child)
+            entry = {'mtime': mtime, 'files': files, 'dirs': dirs}
+            self.dirs[name] = entry
+            self.changed_dirs.add(name)
+            self.changed = True
+        return entry['files'], entry['dirs']
+
+    def find_files(self, extensions):
+        '''
+        recursively look for files that end in the extensions tuple (case
+        insensitive), like :func:`utility.find_files`
+        '''
+        matches = []
+        seen = set()
+        directories = [self.library_dir]
+        while directories:
+            directory = directories.pop()
+            try:
+                files, dirs = self.listing(directory)
+            except OSError as e:
+                log.warning('could not list {}: {}'.format(directory, e))
+                continue
+            seen.add(self.relpath(directory))
+            directories += [os.path.join(directory, d) for d in dirs]
+            for filename in files:
+                for ext in extensions:
+                    if re.search('\.' + ext + '$', filename, re.I):
+                        matches.append(os.path.join(directory, filename))
+                        break
+        for name in set(self.dirs) - seen:
+            del self.dirs[name]
+            self.changed = True
+        return matches
+
+    def book(self, filename, width, height):
+        '''
+        :rtype: a :class:`bookfile_list.BookFile_List` for a native book,
+        which is only opened if the book isn't in the index or has changed
+        :raises BookFormatError: if a book that isn't in the index was
+            converted for other dimensions. One that is raises it when it is
+            first read.
+        '''
+        name = self.relpath(filename)
+        entry = self.books.get(name)
+        if entry is not None and self.relpath(os.path.dirname(filename)) in self.changed_dirs:
+            stat = os.stat(filename)
+            if entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+                entry = None
+        if entry is not None and entry['width'] == width and entry['height'] == height:
+            return BookFile_List(filename, width, height, entry['rows'], entry['title'])
+        book = BookFile_List(filename, width, height, title=title(filename))
+        if book.complete:
+            stat = os.stat(filename)
+            self.books[name] = {
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'width': width,
+                'height': height,
+                'rows': len(book),
+                'title': book.title,
+            }
+            self.changed = True
+        return book
+
+    def write(self, native_files):
+        '''
+        save the index if it has changed, dropping books that aren't in
+        `native_files`
+        '''
+        names = set(map(self.relpath, native_files))
+        for name in set(self.books) - names:
+            del self.books[name]
+            self.changed = True
+        if not self.changed:
+            return
+        to_json = utility.filename_to_json
+        dirs = dict((to_json(name), {'mtime': entry['mtime'],
+                                     'files': map(to_json, entry['files']),
+                                     'dirs': map(to_json, entry['dirs'])})
+                    for name, entry in self.dirs.items())
+        books = dict((to_json(name), entry) for name, entry in self.books.items())
+        data = json.dumps({'version': INDEX_VERSION,
+                           'library_dir': to_json(self.library_dir),
+                           'dirs': dirs, 'books': books})
+        utility.write_atomically(self.index_file, data)
+        self.changed = False
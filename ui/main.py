@@ -5,7 +5,9 @@ import time
 import shutil
 import pwd
 import grp
-import re
+import multiprocessing
+import threading
+import signal
 from driver_pi import Pi
 
 import logging
@@ -15,16 +17,28 @@ import utility
 import argparser
 import config_loader
 from setup_logs import setup_logs
+import store as store_module
 from store import store
-from actions import actions, get_max_pages, get_title, dimensions
+from actions import actions, get_max_pages, get_title, dimensions, get_book_page
+from actions import find_location, typed_query
 import convert
+import manifest
+import library_index
+import search
 import initial_state
 from button_bindings import button_bindings
-from bookfile_list import BookFile_List
+from bookfile_list import BookFile_List, BookFormatError
+from page_cache import PageCache
+from render_scheduler import RenderScheduler
 
 
 NATIVE_EXTENSION = 'canute'
+# books copied from a usb stick, and removed when the library is replaced.
+# Text files aren't as any README or log would be taken for a book, they are
+# only converted when put in the library directly.
 BOOK_EXTENSIONS = (NATIVE_EXTENSION, 'pef', 'brf')
+# books looked for in the library
+LIBRARY_EXTENSIONS = (NATIVE_EXTENSION,) + convert.CONVERT_EXTENSIONS
 
 def main():
     args = argparser.parser.parse_args()
@@ -32,6 +46,13 @@ def main():
     config = config_loader.load()
     log = setup_logs(config, args.loglevel)
 
+    if args.profile_actions:
+        store_module.instrument()
+        signal.signal(signal.SIGUSR1, lambda signum, frame: store_module.dump_stats())
+
+    # before the drivers, which can start threads of their own
+    start_pool(config.getint('conversion', 'workers'))
+
     if args.emulated and not args.both:
         log.info("running with emulated hardware")
         from driver_emulated import Emulated
@@ -45,18 +66,31 @@ def main():
             run(driver, config)
     else:
         timeout = config.get('comms', 'timeout')
+        window = config.getint('comms', 'window')
         log.info("running with real hardware on port %s, timeout %s" % (args.tty, timeout))
-        with Pi(port=args.tty, pi_buttons=args.pi_buttons, timeout=timeout) as driver:
+        with Pi(port=args.tty, pi_buttons=args.pi_buttons, timeout=timeout,
+                window=window) as driver:
             run(driver, config)
 
 
+state_writer = initial_state.StateWriter()
+
+
 def run(driver, config):
+    page_cache.max_bytes = config.getint('cache', 'size')
+    state_writer.interval = config.getfloat('state', 'write_interval')
     init_state    = initial_state.read()
     width, height = driver.get_dimensions()
     init_state    = init_state.copy(dimensions = frozendict({'width': width, 'height': height}), resetting_display = 'start')
     store.dispatch(actions.init(init_state))
-    sync_library(init_state, config.get('files', 'library_dir'))
-    store.subscribe(partial(handle_changes, driver, config))
+    sync_library(init_state, config.get('files', 'library_dir'),
+            config.getint('conversion', 'workers'),
+            config.getboolean('conversion', 'compress'))
+    # the display is updated on a thread of its own so that buttons keep
+    # being read while it is moving
+    scheduler = RenderScheduler(partial(render, driver))
+    scheduler.start()
+    store.subscribe(partial(handle_changes, config, scheduler))
 
     # if we startup and update_ui is still 'in progress' then we are using the old state file
     # and update has failed
@@ -69,45 +103,68 @@ def run(driver, config):
     # won't dispatch if the library is already in sync so there would be no
     # guarantee of the subscription triggering if subscribed before that.
     store.dispatch(actions.trigger())
-    button_loop(driver)
+    button_loop(driver, scheduler)
 
 
-def button_loop(driver):
+def button_loop(driver, scheduler):
     quit = False
     while not quit:
         buttons  = driver.get_buttons()
+        finish_conversions()
         state    = store.get_state()
-        location = state['location']
-        if not isinstance(driver, Pi):
+        if isinstance(driver, Pi):
+            if state['shutting_down']:
+                # let the display be cleared first
+                scheduler.wait()
+                state_writer.schedule(state)
+                state_writer.flush()
+                os.system("sudo shutdown -h now")
+                quit = True
+        else:
             if not driver.is_ok():
                 log.debug('shutting down due to GUI closed')
                 store.dispatch(actions.shutdown())
             if state['shutting_down'] or state['update_ui'] == 'in progress':
                 log.debug("shutting down due to state change")
-                initial_state.write(state)
+                scheduler.wait()
+                state_writer.schedule(state)
+                state_writer.flush()
+                log.info('page cache {}'.format(page_cache.stats()))
+                store_module.dump_stats()
+                log.info('display rows {}'.format(driver.row_stats()))
+                log.info('frames {}'.format(scheduler.stats()))
                 quit = True
-        if type(location) == int:
-            location = 'book'
-        for _id in buttons:
-            _type = buttons[_id]
-            try:
-                store.dispatch(button_bindings[location][_type][_id]())
-            except KeyError:
-                log.debug('no binding for key {}, {} press'.format(_id, _type))
+        dispatch_buttons(buttons)
 
 
-def handle_changes(driver, config):
+def dispatch_buttons(buttons):
+    location = store.get_state()['location']
+    if type(location) == int:
+        location = 'book'
+    for _id in buttons:
+        _type = buttons[_id]
+        try:
+            store.dispatch(button_bindings[location][_type][_id]())
+        except KeyError:
+            log.debug('no binding for key {}, {} press'.format(_id, _type))
+
+
+def handle_changes(config, scheduler):
     state = store.get_state()
-    render(driver, state)
+    scheduler.submit(state)
     change_files(config, state)
-    initial_state.write(state)
-    if state['shutting_down'] and isinstance(driver, Pi):
-        os.system("sudo shutdown -h now")
+    state_writer.schedule(state)
 
 
-def render(driver, state):
+def render(driver, state, stale=None):
+    '''
+    :param stale: function called between rows, returns True if there is a
+    newer state to show instead
+    :rtype: False if it gave up part way through the page
+    '''
     width, height = dimensions(state)
     location = state['location']
+    done = True
     if state['resetting_display'] == 'start':
         store.dispatch(actions.reset_display('in progress'))
         driver.reset_display()
@@ -135,7 +192,7 @@ def render(driver, state):
         while len(data) < data_height:
             data += ((0,) * width,)
         title       = format_title('library menu', width, page, max_pages)
-        set_display(driver, tuple([title]) + tuple(data))
+        done = set_display(driver, tuple([title]) + tuple(data), stale)
     elif location == 'menu':
         page      = state['menu']['page']
         data      = state['menu']['data']
@@ -148,52 +205,241 @@ def render(driver, state):
         #pad page with empty rows
         while len(data) < data_height:
             data += ((0,) * width,)
-        set_display(driver, tuple([title]) + tuple(data))
+        done = set_display(driver, tuple([title]) + tuple(data), stale)
+    elif location == 'search':
+        search = state['search']
+        # the end of a query that doesn't fit on a row
+        query = typed_query(search)[-width:]
+        if search['searching']:
+            status = 'searching'
+        elif search['query'] != () and search['results'] == ():
+            status = 'not found'
+        else:
+            status = ''
+        data = (format_title('search', width, 0, 0), utility.pad_line(width, list(query)),
+                utility.pad_line(width, utility.alphas_to_pin_nums(status)))
+        data += ((0,) * width,) * (height - len(data))
+        done = set_display(driver, data, stale)
     elif type(location) == int:
-        page = state['books'][location]['page']
-        data = state['books'][location]['data']
-        n    = page * height
-        data = data[n : n + height]
-        set_display(driver, data)
-
-
-previous_data = []
-def set_display(driver, data):
-    global previous_data
-    if data != previous_data:
-        for row, braille in enumerate(data):
-            driver.set_braille_row(row, braille)
-        previous_data = data
-    else:
-        log.debug('not setting page with identical data')
+        page = get_book_page(state, location)
+        data = state['books'][location]
+        open_book(data)
+        if data.filename not in state['navigation']:
+            load_navigation(data)
+        done = set_display(driver, tuple(page_cache.get_rows(data, page)), stale)
+        if done:
+            # read ahead the pages the buttons are likely to turn to next
+            page_cache.prefetch(data, [page + 1, page - 1, page + 10, page - 10])
+    if type(location) != int:
+        open_book(None)
+    return done
+
+
+page_cache = PageCache()
+current_book = None
+def open_book(book):
+    '''keep the book being read mapped and close the one we've left'''
+    global current_book
+    if book is not current_book:
+        if current_book is not None:
+            page_cache.close(current_book)
+        current_book = book
+
+
+def load_navigation(book):
+    '''
+    put the navigation marks of a book being read in the state, so moving
+    between sections doesn't read the book. A book still being converted is
+    left until it has finished.
+    '''
+    pages = book.navigation()
+    if book.complete:
+        store.dispatch(actions.set_navigation((book.filename, pages)))
+
+
+def set_display(driver, data, stale=None):
+    '''
+    send the rows to the display, the driver skips any it is already showing
+
+    :rtype: False if `stale` said to stop before all the rows were sent
+    '''
+    return driver.set_page(data, stale)
+
 
+def sync_library(state, library_dir, workers=1, compress=False,
+                 index_file=library_index.index_file):
+    '''
+    start converting new books in the background and bring the books in the
+    state in line with the library. Books being converted are added straight
+    away and grow as their pages are written.
 
-def sync_library(state, library_dir):
+    :param index_file: where to keep the :mod:`library_index`
+    '''
     width, height = dimensions(state)
-    convert_library(width, height, library_dir)
-    library_files = map(lambda b: b['data'].filename, state['books'])
-    disk_files = utility.find_files(library_dir, (NATIVE_EXTENSION,))
+    index = library_index.LibraryIndex(library_dir, index_file)
+    conversion = start_conversion(width, height, library_dir, workers, compress, index)
+    if conversion is not None:
+        conversions.append(conversion)
+    library_files = set(state['filenames'])
+    disk_files = index.find_files((NATIVE_EXTENSION,))
+    if conversion is not None:
+        found = set(disk_files)
+        disk_files += filter(lambda f: f not in found, conversion.native_files)
     not_added = filter(lambda f: f not in library_files, disk_files)
     if not_added != []:
-        not_added_data = map(lambda f: BookFile_List(f, width), not_added)
+        not_added_data = []
+        for filename in not_added:
+            try:
+                not_added_data.append(index.book(filename, width, height))
+            except BookFormatError as e:
+                log.warning('not adding book: {}'.format(e))
         store.dispatch(actions.add_books(not_added_data))
-    non_existent = filter(lambda f: f not in disk_files, library_files)
+    index.write(disk_files)
+    disk_files = set(disk_files)
+    non_existent = filter(lambda f: f not in disk_files, state['filenames'])
     if non_existent != []:
         store.dispatch(actions.remove_books(non_existent))
 
 
-def convert_library(width, height, library_dir):
-    file_names = utility.find_files(library_dir, BOOK_EXTENSIONS)
-    for name in file_names:
-        basename, ext = os.path.splitext(os.path.basename(name))
-        if re.match('\.pef$', ext, re.I):
-            log.info("converting pef to canute")
-            native_file = library_dir + basename + '.' + NATIVE_EXTENSION
-            convert.convert_pef(width, height, name, native_file)
-        elif re.match('\.brf$', ext, re.I):
-            log.info("converting brf to canute")
-            native_file = library_dir + basename + '.' + NATIVE_EXTENSION
-            convert.convert_brf(width, height, name, native_file)
+def native_filename(library_dir, book_file):
+    basename = os.path.splitext(os.path.basename(book_file))[0]
+    return library_dir + basename + '.' + NATIVE_EXTENSION
+
+
+class LibraryConversion(object):
+    '''
+    books being converted to native in the background by the
+    :data:`conversion_pool`, or if it hasn't been started by a pool of at most
+    `workers` processes of its own. Books are started in filename order.
+
+    :param jobs: list of arguments for :func:`convert.convert_job`
+    '''
+    def __init__(self, library_dir, jobs, workers):
+        self.library_dir = library_dir
+        self.native_files = [job[3] for job in jobs]
+        log.info("converting %d books to canute" % len(jobs))
+        if conversion_pool is None:
+            self.pool = multiprocessing.Pool(max(1, min(workers, len(jobs))))
+            pool = self.pool
+        else:
+            self.pool = None
+            pool = conversion_pool
+        # chunksize of 1 so a few big books don't end up on one worker
+        self.result = pool.map_async(convert.convert_job, jobs, chunksize=1)
+        if self.pool is not None:
+            self.pool.close()
+
+    def ready(self):
+        return self.result.ready()
+
+    def finish(self):
+        '''
+        wait for the conversion to finish and record it in the manifest
+
+        :rtype: list of the native files written, in filename order
+        '''
+        results = filter(None, self.result.get())
+        if self.pool is not None:
+            self.pool.join()
+        converted = manifest.read(self.library_dir)
+        for native_file, key in results:
+            converted[os.path.basename(native_file)] = key
+        manifest.write(self.library_dir, converted)
+        return [native_file for native_file, key in results]
+
+
+# conversions that haven't been finished yet
+conversions = []
+# the processes the ui converts books with, see start_pool
+conversion_pool = None
+
+
+def start_pool(workers):
+    '''
+    start the processes books are converted with. This has to be done before
+    any threads are started, as a forked process only has the thread that
+    forked it and would hang on any lock another thread held, e.g. one of the
+    logging module's.
+    '''
+    global conversion_pool
+    log.info("starting %d conversion workers" % workers)
+    conversion_pool = multiprocessing.Pool(max(1, workers))
+
+
+def start_conversion(width, height, library_dir, workers=1, compress=False, index=None):
+    '''
+    start converting any pef, brf or txt books in the library to native. Books
+    whose native file the manifest says was converted from identical content
+    are not converted again. Only the first, in filename order, of books that
+    would be converted to the same native file is converted.
+
+    :param compress: store the pages of new native books compressed
+    :param index: a :class:`library_index.LibraryIndex` to find the books with
+    :rtype: a :class:`LibraryConversion` or None if there is nothing to convert
+    '''
+    converted = manifest.read(library_dir)
+    if index is None:
+        book_files = utility.find_files(library_dir, LIBRARY_EXTENSIONS)
+    else:
+        book_files = index.find_files(LIBRARY_EXTENSIONS)
+    jobs = []
+    native_files = set()
+    for name in sorted(book_files):
+        if convert.can_convert(name):
+            native_file = native_filename(library_dir, name)
+            # e.g. a.pef and a.brf, or books of the same name in two
+            # directories, would be written to the same file at once
+            if native_file in native_files:
+                log.warning('not converting {}, another book is converted to {}'.format(
+                    name, native_file))
+                continue
+            native_files.add(native_file)
+            cached_key = converted.get(os.path.basename(native_file))
+            jobs.append((width, height, name, native_file, cached_key, compress))
+    if jobs == []:
+        return None
+    return LibraryConversion(library_dir, jobs, workers)
+
+
+def convert_library(width, height, library_dir, workers=1, compress=False):
+    '''
+    convert the library and wait for it to finish
+
+    :rtype: list of the native files written, in filename order
+    '''
+    conversion = start_conversion(width, height, library_dir, workers, compress)
+    if conversion is None:
+        return []
+    return conversion.finish()
+
+
+def finish_conversions(wait=False):
+    '''
+    finish any background conversions that are done, or all of them if
+    `wait`. The converted books are added to the library afresh, replacing
+    what was read of them before, and books that failed to convert are
+    dropped.
+    '''
+    for conversion in conversions[:]:
+        if wait or conversion.ready():
+            conversions.remove(conversion)
+            native_files = conversion.finish()
+            search_index.forget(native_files)
+            failed = filter(lambda f: f not in native_files, conversion.native_files)
+            if failed != []:
+                store.dispatch(actions.remove_books(failed))
+            # books that were left out by sync_library, e.g. because their old
+            # native file was for other dimensions, or were read as legacy
+            # books before the converter rewrote them
+            width, height = dimensions(store.get_state())
+            converted = []
+            for native_file in native_files:
+                try:
+                    converted.append(BookFile_List(native_file, width, height,
+                                                   title=library_index.title(native_file)))
+                except BookFormatError as e:
+                    log.warning('not adding book: {}'.format(e))
+            store.dispatch(actions.add_books(converted))
 
 
 def change_files(config, state):
@@ -204,6 +450,9 @@ def change_files(config, state):
     if state['backing_up_log'] == 'start':
         store.dispatch(actions.backup_log('in progress'))
         backup_log(config)
+    if state['search']['searching'] == 'start':
+        store.dispatch(actions.search_started())
+        start_search(state)
     if state['update_ui'] == 'start':
         log.info("update ui = start")
         if utility.find_ui_update(config):
@@ -213,6 +462,54 @@ def change_files(config, state):
             store.dispatch(actions.update_ui('failed'))
 
 
+search_index = search.SearchIndex()
+# searches are done one at a time, in the order they were started
+search_lock = threading.Lock()
+def search_library(state):
+    ''':rtype: `(filename, page)` of the pages matching the search query'''
+    width, height = dimensions(state)
+    query = state['search']['query']
+    if state['search']['page'] is not None:
+        query = first_row(state, *state['search']['page'])
+    search_index.update(state['filenames'], width, height)
+    return search_index.search(query)
+
+
+def first_row(state, filename, page):
+    ''':rtype: the first row of a page of a book, empty if the book has gone'''
+    location = find_location(filename, state['filenames'])
+    if location == 'library':
+        return ()
+    width, height = dimensions(state)
+    rows = state['books'][location][page * height:page * height + 1]
+    return rows[0] if rows else ()
+
+
+def start_search(state):
+    '''
+    search the library on a thread of its own, loading the search files of
+    new books can take a while. Results for a search that has since been
+    replaced by another are dropped.
+
+    :rtype: the thread
+    '''
+    def search_thread():
+        with search_lock:
+            try:
+                results = search_library(state)
+            except Exception:
+                log.exception('could not search the library')
+                results = []
+            search = store.get_state()['search']
+            if (search['query'], search['page']) == (state['search']['query'],
+                                                     state['search']['page']):
+                store.dispatch(actions.search_results(results))
+    thread = threading.Thread(target=search_thread)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
 def format_title(title, width, page_number, total_pages):
     '''
     format a title like this:
@@ -244,11 +541,27 @@ def replace_library(config, state):
     library_dir = config.get('files', 'library_dir')
     usb_dir = config.get('files', 'usb_dir')
     owner = config.get('user', 'user_name')
-    wipe_library(library_dir)
+    width, height = dimensions(state)
+    # don't wipe books from under a conversion
+    finish_conversions(wait=True)
     new_books = utility.find_files(usb_dir, BOOK_EXTENSIONS)
+    # keep native files that were converted from identical books
+    converted = manifest.read(library_dir)
+    keep = []
+    for filename in new_books:
+        native_file = native_filename(library_dir, filename)
+        cached_key = converted.get(os.path.basename(native_file))
+        if cached_key is not None and os.path.exists(native_file):
+            if cached_key == convert.source_key(filename, width, height,
+                    config.getboolean('conversion', 'compress')):
+                keep.append(native_file)
+    wipe_library(library_dir, keep)
     uid = pwd.getpwnam(owner).pw_uid
     gid = grp.getgrnam(owner).gr_gid
     for filename in new_books:
+        if native_filename(library_dir, filename) in keep:
+            log.info('{} is unchanged, not copying it'.format(filename))
+            continue
         log.info('copying {} to {}'.format(filename, library_dir))
         shutil.copy(filename, library_dir)
 
@@ -257,9 +570,8 @@ def replace_library(config, state):
         new_path = library_dir + basename
         log.debug('changing ownership of {} from {} to {}'.format(new_path, uid, gid))
         os.chown(new_path, uid, gid)
-    width = state['display']['width']
-    height = state['display']['height']
-    sync_library(state, library_dir)
+    sync_library(state, library_dir, config.getint('conversion', 'workers'),
+            config.getboolean('conversion', 'compress'))
     store.dispatch(actions.replace_library('done'))
 
 
@@ -276,9 +588,11 @@ def backup_log(config):
     store.dispatch(actions.backup_log('done'))
 
 
-def wipe_library(library_dir):
-    for book in utility.find_files(library_dir, BOOK_EXTENSIONS):
-        os.remove(book)
+def wipe_library(library_dir, keep=()):
+    keep = list(keep) + map(search.search_filename, keep)
+    for book in utility.find_files(library_dir, BOOK_EXTENSIONS + (search.SEARCH_EXTENSION,)):
+        if book not in keep:
+            os.remove(book)
 
 
 if __name__ == '__main__':
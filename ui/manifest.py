@@ -0,0 +1,49 @@
+'''
+Manifest
+========
+
+records which source book each native file in the library was converted from
+so that re-importing an unchanged book doesn't convert it again. Entries map
+the native file's basename to the key given by :func:`convert.source_key`.
+'''
+import os
+import json
+import logging
+log = logging.getLogger(__name__)
+
+import utility
+
+manifest_file = '.canute-manifest.json'
+# version 2 stores basenames with utility.filename_to_json
+MANIFEST_VERSION = 2
+
+
+def read(library_dir):
+    '''
+    :rtype: dict of native basename to source key, empty if there is no
+    manifest or it can't be read
+    '''
+    filename = os.path.join(library_dir, manifest_file)
+    try:
+        with open(filename) as fh:
+            manifest = json.load(fh)
+        if manifest['version'] != MANIFEST_VERSION:
+            log.info('ignoring manifest version %s' % manifest['version'])
+            return {}
+        return dict((utility.filename_from_json(name), key)
+                    for name, key in manifest['books'].items())
+    except (IOError, ValueError, KeyError, TypeError) as e:
+        log.debug('no usable manifest in %s: %s' % (library_dir, e))
+        return {}
+
+
+def write(library_dir, books):
+    '''
+    write the manifest, dropping entries for native files that no longer exist
+
+    :param books: dict of native basename to source key
+    '''
+    books = dict((utility.filename_to_json(name), key) for name, key in books.items()
+                 if os.path.exists(os.path.join(library_dir, name)))
+    data = json.dumps({'version': MANIFEST_VERSION, 'books': books})
+    utility.write_atomically(os.path.join(library_dir, manifest_file), data)
@@ -0,0 +1,122 @@
+'''
+Page cache
+==========
+
+a bounded cache of book pages shared by all books, so that turning to a page
+that has been read or prefetched doesn't wait on the SD card. Pages are
+evicted least recently used first once the cache holds more than `max_bytes`
+of cells. :meth:`PageCache.prefetch` loads pages on a background thread.
+
+books hold a lock of their own while they are read, so the prefetching
+thread can read from a book while the ui reads from or closes it.
+'''
+import logging
+import threading
+import Queue
+from collections import OrderedDict
+log = logging.getLogger(__name__)
+
+
+class PageCache(object):
+    '''
+    :param max_bytes: how many bytes of page cells to keep
+    '''
+    def __init__(self, max_bytes=256 * 1024):
+        self.max_bytes = max_bytes
+        self.pages = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # guards the cached pages and counters
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.thread = None
+
+    def key(self, book, page):
+        # the inode changes when a book is converted again under the same name,
+        # update notices that before the book's mapping is used
+        with book.lock:
+            book.update()
+            book.mapping()
+            return (book.filename, book.map_inode, page)
+
+    def get(self, book, page):
+        '''
+        :param book: a :class:`bookfile_list.BookFile_List`
+        :rtype: the cells of the page as a string or None if the book doesn't
+        have that page (yet)
+        '''
+        key = self.key(book, page)
+        with self.lock:
+            cells = self.pages.pop(key, None)
+            if cells is not None:
+                self.pages[key] = cells
+                self.hits += 1
+                return cells
+            self.misses += 1
+        return self.load(key, book, page)
+
+    def get_rows(self, book, page):
+        '''
+        :rtype: list of the rows of a page as buffers of cells, blank if they
+        are past the end of the book
+        '''
+        cells = self.get(book, page)
+        height = book.page_height()
+        if cells is None:
+            # a page that is only partly written, or past the end
+            return book.get_rows(page * height, (page + 1) * height)
+        return [buffer(cells, row * book.cells, book.cells) for row in range(height)]
+
+    def load(self, key, book, page):
+        with book.lock:
+            cells = book.get_page(page)
+            if cells is None:
+                return None
+            cells = str(cells)
+        with self.lock:
+            if key not in self.pages:
+                self.pages[key] = cells
+                self.size += len(cells)
+            while self.size > self.max_bytes and self.pages:
+                _, evicted = self.pages.popitem(last=False)
+                self.size -= len(evicted)
+        return cells
+
+    def prefetch(self, book, pages):
+        '''load pages of a book into the cache in the background'''
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.prefetch_loop)
+            self.thread.daemon = True
+            self.thread.start()
+        self.queue.put((book, pages))
+
+    def prefetch_loop(self):
+        while True:
+            book, pages = self.queue.get()
+            try:
+                for page in pages:
+                    if page < 0:
+                        continue
+                    key = self.key(book, page)
+                    with self.lock:
+                        cached = key in self.pages
+                    if not cached:
+                        self.load(key, book, page)
+            except Exception as e:
+                log.debug('could not prefetch from {}: {}'.format(book.filename, e))
+            finally:
+                self.queue.task_done()
+
+    def close(self, book):
+        '''close a book, waiting for any read from it to finish'''
+        book.close()
+
+    def wait(self):
+        '''wait for any prefetching to finish'''
+        self.queue.join()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'pages': len(self.pages), 'bytes': self.size}
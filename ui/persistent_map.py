@@ -0,0 +1,236 @@
+'''
+Persistent map
+==============
+
+an immutable mapping where :meth:`PersistentMap.set` and
+:meth:`PersistentMap.remove` return a new map that shares all but a few nodes
+with the old one, so updating one key of a big map is cheap and the old map
+is left as it was. This is what the state keeps reading positions in.
+
+it is a hash array mapped trie: each node holds up to 32 entries, indexed by
+5 bits of the key's hash, and a bitmap of which of them are present. An entry
+is either a key and value or a node for the next 5 bits. Keys whose hashes are
+identical end up together in a collision node.
+'''
+
+BITS = 5
+MASK = (1 << BITS) - 1
+HASH_BITS = 32
+
+
+def _hash(key):
+    return hash(key) & 0xffffffff
+
+
+def _popcount(n):
+    return bin(n).count('1')
+
+
+class _Leaf(object):
+    __slots__ = ('hash', 'key', 'value')
+
+    def __init__(self, h, key, value):
+        self.hash = h
+        self.key = key
+        self.value = value
+
+
+class _Node(object):
+    __slots__ = ('bitmap', 'entries')
+
+    def __init__(self, bitmap, entries):
+        self.bitmap = bitmap
+        self.entries = entries
+
+
+class _Collisions(object):
+    '''leaves whose keys all have the same hash'''
+    __slots__ = ('hash', 'leaves')
+
+    def __init__(self, h, leaves):
+        self.hash = h
+        self.leaves = leaves
+
+
+_EMPTY = _Node(0, ())
+
+
+def _get(node, shift, h, key, default):
+    while True:
+        if type(node) is _Collisions:
+            for leaf in node.leaves:
+                if leaf.key == key:
+                    return leaf.value
+            return default
+        bit = 1 << ((h >> shift) & MASK)
+        if not node.bitmap & bit:
+            return default
+        entry = node.entries[_popcount(node.bitmap & (bit - 1))]
+        if type(entry) is _Leaf:
+            return entry.value if entry.key == key else default
+        node = entry
+        shift += BITS
+
+
+def _merge(shift, a, b):
+    '''a node holding two leaves from `shift` down'''
+    if shift >= HASH_BITS:
+        return _Collisions(a.hash, (a, b))
+    index_a = (a.hash >> shift) & MASK
+    index_b = (b.hash >> shift) & MASK
+    if index_a == index_b:
+        return _Node(1 << index_a, (_merge(shift + BITS, a, b),))
+    entries = (a, b) if index_a < index_b else (b, a)
+    return _Node((1 << index_a) | (1 << index_b), entries)
+
+
+def _set(node, shift, h, key, value):
+    ''':rtype: tuple of the new node and whether a key was added'''
+    if type(node) is _Collisions:
+        if h != node.hash:
+            # a collision node pulled up the trie, push it down a level
+            node = _Node(1 << ((node.hash >> shift) & MASK), (node,))
+            return _set(node, shift, h, key, value)
+        leaves = list(node.leaves)
+        for n, leaf in enumerate(leaves):
+            if leaf.key == key:
+                leaves[n] = _Leaf(h, key, value)
+                return _Collisions(h, tuple(leaves)), False
+        return _Collisions(h, tuple(leaves) + (_Leaf(h, key, value),)), True
+    bit = 1 << ((h >> shift) & MASK)
+    n = _popcount(node.bitmap & (bit - 1))
+    if not node.bitmap & bit:
+        entries = node.entries[:n] + (_Leaf(h, key, value),) + node.entries[n:]
+        return _Node(node.bitmap | bit, entries), True
+    entry = node.entries[n]
+    if type(entry) is _Leaf:
+        if entry.key == key:
+            new, added = _Leaf(h, key, value), False
+        else:
+            new, added = _merge(shift + BITS, entry, _Leaf(h, key, value)), True
+    else:
+        new, added = _set(entry, shift + BITS, h, key, value)
+    return _Node(node.bitmap, node.entries[:n] + (new,) + node.entries[n + 1:]), added
+
+
+def _remove(node, shift, h, key):
+    '''
+    :rtype: the node without `key`, None if that leaves it empty or a leaf
+    if that is all that is left in it, or the node itself if it didn't have
+    the key
+    '''
+    if type(node) is _Collisions:
+        leaves = tuple(leaf for leaf in node.leaves if leaf.key != key)
+        if len(leaves) == len(node.leaves):
+            return node
+        return leaves[0] if len(leaves) == 1 else _Collisions(node.hash, leaves)
+    bit = 1 << ((h >> shift) & MASK)
+    if not node.bitmap & bit:
+        return node
+    n = _popcount(node.bitmap & (bit - 1))
+    entry = node.entries[n]
+    if type(entry) is _Leaf:
+        if entry.key != key:
+            return node
+        new = None
+    else:
+        new = _remove(entry, shift + BITS, h, key)
+        if new is entry:
+            return node
+    if new is None:
+        if len(node.entries) == 1:
+            return None
+        entries = node.entries[:n] + node.entries[n + 1:]
+        if len(entries) == 1 and type(entries[0]) is _Leaf:
+            return entries[0]
+        return _Node(node.bitmap & ~bit, entries)
+    if type(new) is _Leaf and len(node.entries) == 1:
+        # pull a lone leaf up so lookups stay short
+        return new
+    return _Node(node.bitmap, node.entries[:n] + (new,) + node.entries[n + 1:])
+
+
+def _leaves(node):
+    if type(node) is _Leaf:
+        yield node
+    elif type(node) is _Collisions:
+        for leaf in node.leaves:
+            yield leaf
+    else:
+        for entry in node.entries:
+            for leaf in _leaves(entry):
+                yield leaf
+
+
+class PersistentMap(object):
+    '''
+    :param items: dict or iterable of `(key, value)` to start with
+    '''
+    __slots__ = ('root', 'size')
+
+    def __init__(self, items=(), root=_EMPTY, size=0):
+        self.root = root
+        self.size = size
+        if items:
+            if hasattr(items, 'items'):
+                items = items.items()
+            for key, value in items:
+                self.root, added = _set(self.root, 0, _hash(key), key, value)
+                self.size += added
+
+    def get(self, key, default=None):
+        return _get(self.root, 0, _hash(key), key, default)
+
+    def set(self, key, value):
+        ''':rtype: a new map with `key` set to `value`'''
+        root, added = _set(self.root, 0, _hash(key), key, value)
+        return PersistentMap(root=root, size=self.size + added)
+
+    def remove(self, key):
+        ''':rtype: a new map without `key`, or this map if it doesn't have it'''
+        root = _remove(self.root, 0, _hash(key), key)
+        if root is self.root:
+            return self
+        if root is None:
+            root = _EMPTY
+        elif type(root) is not _Node:
+            root = _wrap(root)
+        return PersistentMap(root=root, size=self.size - 1)
+
+    def __getitem__(self, key):
+        value = self.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for leaf in _leaves(self.root):
+            yield leaf.key
+
+    def items(self):
+        return [(leaf.key, leaf.value) for leaf in _leaves(self.root)]
+
+    def __eq__(self, other):
+        if isinstance(other, PersistentMap):
+            other = dict(other.items())
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'PersistentMap(%r)' % dict(self.items())
+
+
+_missing = object()
+
+
+def _wrap(entry):
+    '''put a leaf or collision node that is all that's left back in a root node'''
+    return _Node(1 << (entry.hash & MASK), (entry,))
@@ -3,7 +3,7 @@ from __future__ import print_function
 import argparse
 import logging
 from comms_codes import *
-from utility import pin_num_to_unicode, pin_num_to_alpha
+from utility import pin_nums_to_unicode, pin_nums_to_alphas
 from multiprocessing import Queue
 from Queue import Empty
 import sys
@@ -121,9 +121,9 @@ class Display(QtGui.QMainWindow, Ui_MainWindow):
     def print_braille_row(self, row, row_braille):
         # useful for debugging, show pin number not the braille
         if self.display_text:
-            label_text = ''.join(map(pin_num_to_alpha, row_braille))
+            label_text = ''.join(pin_nums_to_alphas(row_braille))
         else:
-            label_text = ''.join(map(pin_num_to_unicode, row_braille))
+            label_text = pin_nums_to_unicode(row_braille)
         self.label_rows[row].setText(label_text)
 
     def check_msg(self):
@@ -0,0 +1,103 @@
+'''
+Render scheduler
+================
+
+makes sure the display only ever works towards showing the latest state.
+Each row takes the display a while to set, so when the state changes again
+while a page is being drawn the rest of that page is dropped and the newest
+state is drawn instead.
+
+once :meth:`RenderScheduler.start` has been called states are drawn on a
+thread of their own, so buttons keep being read and reduced while the display
+is moving.
+'''
+import threading
+import logging
+log = logging.getLogger(__name__)
+
+
+class RenderScheduler(object):
+    '''
+    :param render: function taking a state and a function to call between
+    rows that returns True if the state is out of date and drawing should
+    stop. It returns False if it stopped early.
+    '''
+    def __init__(self, render):
+        self.render = render
+        self.pending = None
+        self.rendering = False
+        self.frames = 0
+        self.dropped = 0
+        # guards pending and rendering
+        self.lock = threading.Lock()
+        # notified when either changes
+        self.changed = threading.Condition(self.lock)
+        self.thread = None
+
+    def start(self):
+        '''draw states on a thread of their own from now on'''
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, state):
+        '''
+        draw `state`, or have it replace whatever is being drawn. Without a
+        thread it is drawn before this returns.
+        '''
+        with self.lock:
+            if self.pending is not None:
+                # never got drawn at all
+                self.dropped += 1
+            self.pending = state
+            self.changed.notify_all()
+            if self.thread is not None or self.rendering:
+                return
+            self.rendering = True
+        self.render_pending()
+
+    def stale(self):
+        ''':rtype: True if there is a newer state to draw'''
+        return self.pending is not None
+
+    def render_pending(self):
+        '''draw states until there isn't a newer one'''
+        while True:
+            with self.lock:
+                state, self.pending = self.pending, None
+                if state is None:
+                    self.rendering = False
+                    self.changed.notify_all()
+                    return
+            try:
+                done = self.render(state, self.stale)
+            except:
+                with self.lock:
+                    self.rendering = False
+                    self.changed.notify_all()
+                raise
+            if done is False:
+                log.debug('dropped the rest of an out of date frame')
+                self.dropped += 1
+            else:
+                self.frames += 1
+
+    def run(self):
+        while True:
+            with self.lock:
+                while self.pending is None:
+                    self.changed.wait()
+                self.rendering = True
+            try:
+                self.render_pending()
+            except Exception:
+                log.exception('could not render')
+
+    def wait(self):
+        '''block until everything submitted so far has been drawn'''
+        with self.lock:
+            while self.rendering or self.pending is not None:
+                self.changed.wait()
+
+    def stats(self):
+        return {'frames': self.frames, 'dropped': self.dropped}
@@ -0,0 +1,142 @@
+'''
+Search
+======
+
+full text search of the library. When a book is converted the words on each
+of its pages are written to a search file next to it, mapping each word (as
+braille ASCII) to the pages it is on. :class:`SearchIndex` loads the search
+files of the books in the library and answers queries from memory.
+
+a word is a run of cells between blank cells. Words aren't joined across
+rows, so a word hyphenated at the end of a row is indexed as two.
+'''
+import os
+import json
+import logging
+log = logging.getLogger(__name__)
+
+import utility
+from bookfile_list import BookFile_List
+
+SEARCH_EXTENSION = 'canute-words'
+SEARCH_VERSION = 1
+
+# translate pin number bytes to braille ASCII in one go
+_pin_to_ascii_table = utility.BRAILLE_ASCII + ' ' * (256 - len(utility.BRAILLE_ASCII))
+
+
+def search_filename(native_file):
+    return os.path.splitext(native_file)[0] + '.' + SEARCH_EXTENSION
+
+
+def query_words(query):
+    '''
+    :param query: pin numbers typed by the user
+    :rtype: list of the words in the query as braille ASCII
+    '''
+    return str(bytearray(query)).translate(_pin_to_ascii_table).split()
+
+
+def index_book(native_file, width, height):
+    '''
+    :rtype: dict of each word in the book to a sorted list of the pages it is
+    on, or None if the book is still being converted
+    '''
+    book = BookFile_List(native_file, width, height)
+    if not book.complete:
+        return None
+    words = {}
+    for page in range((len(book) + height - 1) // height):
+        page_words = set()
+        for row in book.get_rows(page * height, (page + 1) * height):
+            page_words.update(str(row).translate(_pin_to_ascii_table).split())
+        for word in page_words:
+            words.setdefault(word, []).append(page)
+    book.close()
+    return words
+
+
+def write_index(native_file, width, height):
+    '''
+    :rtype: the words of the book, as given by :func:`index_book`. Nothing
+    is written for a book that is still being converted.
+    '''
+    words = index_book(native_file, width, height)
+    if words is None:
+        return None
+    data = json.dumps({'version': SEARCH_VERSION, 'width': width,
+                       'height': height, 'words': words})
+    utility.write_atomically(search_filename(native_file), data)
+    return words
+
+
+def read_index(native_file, width, height):
+    '''
+    :rtype: the words of the book from its search file, the search file is
+    written first if it is missing or older than the book. None if the book
+    is still being converted, its search file is written once it is done.
+    '''
+    filename = search_filename(native_file)
+    try:
+        if os.path.getmtime(filename) >= os.path.getmtime(native_file):
+            with open(filename) as fh:
+                index = json.load(fh)
+            if (index['version'] == SEARCH_VERSION and index['width'] == width
+                    and index['height'] == height):
+                return index['words']
+    except (OSError, IOError, ValueError, KeyError, TypeError) as e:
+        log.debug('no usable search file for %s: %s' % (native_file, e))
+    log.info('indexing %s for search' % native_file)
+    return write_index(native_file, width, height)
+
+
+class SearchIndex(object):
+    '''
+    the words of every book in the library, kept up to date with
+    :meth:`update` as books are added and removed
+    '''
+    def __init__(self):
+        # native filename to dict of word to pages
+        self.books = {}
+
+    def update(self, native_files, width, height):
+        '''load any new books and forget those that have gone'''
+        native_files = set(native_files)
+        for native_file in set(self.books) - native_files:
+            del self.books[native_file]
+        for native_file in native_files - set(self.books):
+            try:
+                words = read_index(native_file, width, height)
+            except (OSError, IOError) as e:
+                log.warning('could not index {}: {}'.format(native_file, e))
+                continue
+            # left out until it has finished converting
+            if words is not None:
+                self.books[native_file] = words
+
+    def forget(self, native_files):
+        '''forget books that have been converted again so they are reloaded'''
+        for native_file in native_files:
+            self.books.pop(native_file, None)
+
+    def search(self, query):
+        '''
+        :param query: pin numbers of one or more words
+        :rtype: sorted list of `(native filename, page)` of the pages that
+        have all the words on them
+        '''
+        words = query_words(query)
+        if words == []:
+            return []
+        results = []
+        for native_file, book_words in self.books.items():
+            pages = None
+            for word in words:
+                found = book_words.get(word)
+                if found is None:
+                    pages = None
+                    break
+                pages = set(found) if pages is None else pages.intersection(found)
+            if pages:
+                results += [(native_file, page) for page in pages]
+        return sorted(results)
@@ -1,4 +1,6 @@
 import os
+import time
+import threading
 import pydux
 
 import logging
@@ -16,11 +18,61 @@ for name in dir(reducers):
     if not name.startswith('__'):
         reducer_dict[name] = getattr(reducers, name)
 
+# action type to [count, seconds] while instrumented, see instrument()
+timings = None
+
+def instrument(enabled = True):
+    '''start (or stop) recording how many of each type of action are reduced
+    and how long their reducers take'''
+    global timings
+    timings = {} if enabled else None
+
+def stats():
+    ''':rtype: dict of action type to a dict of its count and total seconds'''
+    if timings is None:
+        return {}
+    return dict((name, {'count': count, 'seconds': seconds})
+                for name, (count, seconds) in timings.items())
+
+def dump_stats():
+    '''log the instrumented action counts and times, slowest first'''
+    for name, timing in sorted(stats().items(), key = lambda s: -s[1]['seconds']):
+        log.info('%-20s %6d actions %9.3f ms total %7.3f ms mean' % (name, timing['count'],
+                 timing['seconds'] * 1000, timing['seconds'] * 1000 / timing['count']))
+
 def reducer(state, action = None):
-    log.debug(action)
-    for name in reducer_dict:
-        if action['type'] == name:
-            return reducer_dict[name](state, action['value'])
+    name = action['type']
+    # let logging format the value only if it is going to be shown, it can
+    # be a whole list of books
+    log.debug('%s %r', name, action.get('value'))
+    method = reducer_dict.get(name)
+    if method is None:
+        return state
+    if timings is None:
+        return method(state, action['value'])
+    start = time.time()
+    state = method(state, action['value'])
+    timing = timings.setdefault(name, [0, 0.0])
+    timing[0] += 1
+    timing[1] += time.time() - start
     return state
 
-store = pydux.create_store(reducer)
+def locked(create_store):
+    '''
+    store enhancer that lets actions be dispatched from more than one thread,
+    e.g. by the button loop while the render thread is updating the display.
+    Dispatches are done one at a time, though a subscriber may still dispatch
+    from within one.
+    '''
+    def create(reducer, initial_state = None):
+        store = create_store(reducer, initial_state)
+        lock = threading.RLock()
+        dispatch = store['dispatch']
+        def locked_dispatch(action):
+            with lock:
+                return dispatch(action)
+        store['dispatch'] = locked_dispatch
+        return store
+    return create
+
+store = pydux.create_store(reducer, enhancer = locked)
@@ -3,21 +3,40 @@ from multiprocessing import Process
 from frozendict import frozendict
 import unittest
 import os
+import shutil
+import tempfile
+import pickle
+import json
 import pty
 import struct
 import math
+import time
+import threading
 import mock
 
-from bookfile_list import BookFile_List
+from bookfile_list import BookFile_List, BookFormatError
+from page_cache import PageCache
+from library_index import LibraryIndex
+from persistent_map import PersistentMap
+from driver import Driver
 from driver_pi import Pi
 from setup_logs import setup_logs
 import utility
 import comms_codes as comms
 import config_loader
 import convert
+import manifest
+import book_format
+import search
+import store
 import actions
-from initial_state import initial_state
-from main import sync_library
+from initial_state import initial_state, StateWriter
+from initial_state import read as read_state
+from initial_state import write as write_state
+import main
+from main import sync_library, convert_library, finish_conversions, set_display
+from main import wipe_library, start_search, first_row
+from render_scheduler import RenderScheduler
 if "TRAVIS" not in os.environ:
     from driver_emulated import Emulated
     
@@ -30,16 +49,47 @@ class TestUtility(unittest.TestCase):
         for p in range(64):
             self.assertEqual(utility.unicode_to_pin_num(utility.pin_num_to_unicode(p)), p)
 
+    def test_unicodes_to_pin_nums(self):
+        row = utility.pin_nums_to_unicode(range(64))
+        self.assertEqual(utility.unicodes_to_pin_nums(row), (str(bytearray(range(64))), 0))
+        # 8 dot patterns and anything else are blank and counted
+        pin_nums, invalid = utility.unicodes_to_pin_nums(u'\u2801\u2840a\u2802')
+        self.assertEqual(pin_nums, '\x01\x00\x00\x02')
+        self.assertEqual(invalid, 2)
+
     def test_pin_num_to_alpha(self):
         for p in range(64):
             self.assertEqual(utility.alpha_to_pin_num(utility.pin_num_to_alpha(p)), p)
 
+    def test_alpha_to_pin_table(self):
+        for p in range(64):
+            alpha = utility.pin_num_to_alpha(p)
+            self.assertEqual(ord(alpha.translate(utility.alpha_to_pin_table)), p)
+            self.assertEqual(ord(alpha.lower().translate(utility.alpha_to_pin_table)), p)
+
     def test_find_files(self):
         self.assertEqual(len(utility.find_files('../test-books', ('brf',))), 2)
         self.assertEqual(len(utility.find_files('../test-books', ('pef',))), 1)
         self.assertEqual(len(utility.find_files('../test-books', ('brf','pef'))), 3)
 
 
+class TestConfig(unittest.TestCase):
+    def test_defaults(self):
+        '''options left out of the shipped config still read as numbers'''
+        config = config_loader.load('config.rc')
+        self.assertGreaterEqual(config.getint('conversion', 'workers'), 1)
+        self.assertGreater(config.getint('comms', 'window'), 0)
+        self.assertGreater(config.getint('cache', 'size'), 0)
+        self.assertGreater(config.getfloat('state', 'write_interval'), 0)
+        self.assertFalse(config.getboolean('conversion', 'compress'))
+        # even ones that aren't in it at all
+        config = config_loader.load('config-test.rc')
+        self.assertGreaterEqual(config.getint('conversion', 'workers'), 1)
+        self.assertEqual(config.getint('comms', 'window'), 4)
+        self.assertEqual(config.getint('cache', 'size'), 256 * 1024)
+        self.assertEqual(config.getfloat('state', 'write_interval'), 2)
+
+
 class TestBookFile_List(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -54,7 +104,7 @@ class TestBookFile_List(unittest.TestCase):
             for page in pages:
                 fh.write(bytearray(page))
 
-        cls._bookfile = BookFile_List(cls._book, cls._width)
+        cls._bookfile = BookFile_List(cls._book, cls._width, 8)
 
     def test_book_file_create(self):
         self.assertIsInstance(self._bookfile, BookFile_List)
@@ -70,6 +120,82 @@ class TestBookFile_List(unittest.TestCase):
             expected_pin = i + (i << 3)
             self.assertEqual(self._bookfile[i*h:i*h+1][0], (expected_pin,) * w)
 
+    def test_book_file_pages(self):
+        book = BookFile_List(self._book, self._width, 8)
+        for i in range(8):
+            expected_pin = i + (i << 3)
+            self.assertEqual(str(book.get_page(i)), chr(expected_pin) * self._width * 8)
+            rows = book.get_rows(i * 8, i * 8 + 2)
+            self.assertEqual(map(str, rows), [chr(expected_pin) * self._width] * 2)
+        self.assertEqual(book.get_page(8), None)
+
+    def test_book_file_pickle(self):
+        book = pickle.loads(pickle.dumps(self._bookfile))
+        self.assertEqual(book.filename, self._book)
+        self.assertEqual(len(book), self._len)
+        self.assertEqual(book[8:9], self._bookfile[8:9])
+
+    def test_page_cache(self):
+        book = BookFile_List(self._book, self._width, 8)
+        page_bytes = self._width * 8
+        cache = PageCache(max_bytes=page_bytes * 2)
+        self.assertEqual(cache.get(book, 1), chr(9) * page_bytes)
+        self.assertEqual(cache.get(book, 1), chr(9) * page_bytes)
+        self.assertEqual(cache.get(book, 8), None)
+        cache.prefetch(book, [2, 0, 11, -9])
+        cache.wait()
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+        # only the last two pages read fit
+        self.assertEqual((stats['pages'], stats['bytes']), (2, page_bytes * 2))
+        self.assertEqual(map(str, cache.get_rows(book, 0)), [chr(0) * self._width] * 8)
+        self.assertEqual(cache.stats()['hits'], 2)
+        cache.close(book)
+
+    def test_book_file_no_height(self):
+        '''legacy books don't say how tall a page is'''
+        self.assertRaises(BookFormatError, BookFile_List, self._book, self._width)
+
+    def test_book_file_replaced(self):
+        '''a finished book is read again once it has been converted again'''
+        native_file = '/tmp/replaced_test.canute'
+        self.addCleanup(os.remove, native_file)
+        txt_file = '/tmp/replaced_test.txt'
+        for text in ('first', 'second book'):
+            with open(txt_file, 'w') as fh:
+                fh.write(text)
+            convert.convert_txt(12, 4, txt_file, native_file)
+            if text == 'first':
+                book = BookFile_List(native_file, 12, 4)
+                first = str(book.get_page(0))
+        self.assertNotEqual(str(book.get_page(0)), first)
+        row = ''.join(utility.pin_nums_to_alphas(book[0:1][0])).rstrip()
+        self.assertEqual(row, 'SECOND BOOK')
+        # pages cached from the old book aren't used for the new one
+        cache = PageCache()
+        self.assertEqual(''.join(utility.pin_nums_to_alphas(bytearray(cache.get(book, 0)[:12]))).rstrip(),
+                         'SECOND BOOK')
+        with open(txt_file, 'w') as fh:
+            fh.write('third')
+        convert.convert_txt(12, 4, txt_file, native_file)
+        row = bytearray(cache.get(book, 0)[:12])
+        self.assertEqual(''.join(utility.pin_nums_to_alphas(row)).rstrip(), 'THIRD')
+
+    def test_book_file_gone(self):
+        '''a book whose file goes before it is read has blank pages'''
+        native_file = '/tmp/gone_test.canute'
+        for compress in (False, True):
+            with book_format.open_new(native_file) as fh:
+                writer = book_format.BookWriter(fh, 12, 4, compress=compress)
+                writer.write_row('\x01' * 12)
+                writer.close()
+            book = BookFile_List(native_file, 12, 4)
+            self.assertEqual(len(book), 4)
+            os.remove(native_file)
+            self.assertEqual(book.get_page(0), None)
+            self.assertEqual(book[0:2], [(0,) * 12] * 2)
+            self.assertEqual(book.navigation(), [])
+
     @classmethod
     def tearDownClass(cls):
         os.unlink(cls._book)
@@ -102,6 +228,179 @@ class TestDriverEmulated(unittest.TestCase):
         cls._driver.__exit__(None, None, None)
 
 
+class FakeDriver(Driver):
+    '''
+    a display of 4 rows of 10 cells that records what it is sent. Rows and
+    pages get the statuses in `statuses` and then 0.
+    '''
+    def __init__(self, window=1, firmware=1):
+        self.sent = []
+        self.statuses = []
+        self.replies = 0
+        self.firmware = firmware
+        super(FakeDriver, self).__init__(window)
+
+    def is_ok(self):
+        return True
+
+    def send_error_sound(self):
+        pass
+
+    def send_ok_sound(self):
+        pass
+
+    def get_buttons(self):
+        return {}
+
+    def send_data(self, cmd, data=[]):
+        self.sent.append((cmd, data))
+        self.cmd = cmd
+
+    def get_data(self, expected_cmd):
+        self.replies += 1
+        if self.cmd in (comms.CMD_SEND_LINE, comms.CMD_SEND_PAGE) and self.statuses:
+            return self.statuses.pop(0)
+        return {comms.CMD_GET_CHARS: 10, comms.CMD_GET_ROWS: 4,
+                comms.CMD_SEND_VERSION: self.firmware}.get(self.cmd, 0)
+
+
+class TestDriver(unittest.TestCase):
+    def sent_rows(self, driver):
+        rows = [data[0] for cmd, data in driver.sent if cmd == comms.CMD_SEND_LINE]
+        driver.sent = []
+        return rows
+
+    def test_shadow(self):
+        '''only rows that change are sent'''
+        driver = FakeDriver()
+        page = [[1] * 10, [2] * 10, [0] * 10, [0] * 10]
+        driver.set_braille(sum(page, []))
+        self.assertEqual(self.sent_rows(driver), [0, 1, 2, 3])
+        page[1] = [3] * 10
+        for row, data in enumerate(page):
+            driver.set_braille_row(row, data)
+        self.assertEqual(self.sent_rows(driver), [1])
+        self.assertEqual(driver.row_stats(), {'sent': 5, 'skipped': 3})
+        # strings of pin number bytes are the same rows
+        driver.set_braille_row(0, '\x01' * 10)
+        self.assertEqual(self.sent_rows(driver), [])
+        driver.reset_display()
+        driver.set_braille_row(0, page[0])
+        self.assertEqual(self.sent_rows(driver), [0])
+        driver.clear_page()
+        self.assertEqual(self.sent_rows(driver), [0, 1, 2, 3])
+
+    def test_window(self):
+        '''rows are sent ahead of their statuses and errors go one at a time'''
+        driver = FakeDriver(window=3)
+        driver.replies = 0
+        driver.set_braille_row(0, [1] * 10)
+        driver.set_braille_row(1, [1] * 10)
+        self.assertEqual(driver.replies, 0)
+        driver.set_braille_row(2, [1] * 10)
+        self.assertEqual(driver.replies, 1)
+        driver.flush()
+        self.assertEqual(driver.replies, 3)
+        # the second row of a page fails
+        driver.statuses = [0, 1]
+        driver.set_braille([2] * 40)
+        self.assertEqual(driver.replies, 7)
+        self.assertTrue(driver.stop_and_wait)
+        self.assertEqual(driver.shadow, [str(bytearray([2] * 10)), None] +
+                         [str(bytearray([2] * 10))] * 2)
+        # one row at a time until a page gets through
+        self.sent_rows(driver)
+        driver.set_braille_row(1, [2] * 10)
+        self.assertEqual(self.sent_rows(driver), [1])
+        self.assertEqual(driver.replies, 8)
+        driver.flush()
+        self.assertFalse(driver.stop_and_wait)
+        driver.set_braille_row(0, [3] * 10)
+        self.assertEqual(driver.replies, 8)
+
+    def test_page(self):
+        '''newer firmware gets the whole page at once, if any of it changed'''
+        driver = FakeDriver(firmware=comms.VERSION_SEND_PAGE)
+        self.assertTrue(driver.send_pages)
+        driver.sent = []
+        page = [[1] * 10, [2] * 5, [0] * 10]
+        self.assertTrue(driver.set_page(page))
+        # short and missing rows are filled with blank cells
+        self.assertEqual(driver.sent, [(comms.CMD_SEND_PAGE,
+                         [1] * 10 + [2] * 5 + [0] * 25)])
+        driver.sent = []
+        driver.set_page(page)
+        self.assertEqual(driver.sent, [])
+        self.assertEqual(driver.row_stats(), {'sent': 4, 'skipped': 4})
+        page[1] = [3] * 10
+        driver.set_page(page)
+        self.assertEqual(driver.sent, [(comms.CMD_SEND_PAGE,
+                         [1] * 10 + [3] * 10 + [0] * 20)])
+        self.assertEqual(driver.row_stats(), {'sent': 5, 'skipped': 7})
+        # after an error the page is sent again
+        driver.statuses = [1]
+        driver.set_braille([4] * 40)
+        self.assertEqual(driver.shadow, [None] * 4)
+        driver.sent = []
+        driver.set_braille([4] * 40)
+        self.assertEqual(driver.sent, [(comms.CMD_SEND_PAGE, [4] * 40)])
+        self.assertEqual(driver.shadow, [str(bytearray([4] * 10))] * 4)
+        # older firmware gets a row at a time
+        driver = FakeDriver()
+        self.assertFalse(driver.send_pages)
+        driver.set_page(page)
+        self.assertEqual(self.sent_rows(driver), [0, 1, 2])
+
+
+class TestRenderScheduler(unittest.TestCase):
+    pages = [[[n] * 10] * 4 for n in range(1, 5)]
+
+    def sent_rows(self, driver):
+        return [(data[0], data[1]) for cmd, data in driver.sent if cmd == comms.CMD_SEND_LINE]
+
+    def test_latest_state_wins(self):
+        '''presses while a page is drawn skip to the last page pressed for'''
+        driver = FakeDriver()
+        presses = [2, 3, 4]
+        def render(n, stale):
+            def press():
+                # a press arrives once a row of each page has been sent
+                if presses and len(self.sent_rows(driver)) == 4 - len(presses):
+                    scheduler.submit(presses.pop(0))
+                return stale()
+            return set_display(driver, self.pages[n - 1], press)
+        scheduler = RenderScheduler(render)
+        scheduler.submit(1)
+        # only the first row of pages 1 to 3 was sent
+        self.assertEqual(self.sent_rows(driver),
+                         [(0, 1), (0, 2), (0, 3), (0, 4), (1, 4), (2, 4), (3, 4)])
+        self.assertEqual(scheduler.stats(), {'frames': 1, 'dropped': 3})
+        # a state that arrives while idle is drawn straight away
+        scheduler.submit(1)
+        self.assertEqual(scheduler.stats(), {'frames': 2, 'dropped': 3})
+
+    def test_thread(self):
+        '''submitting doesn't wait for the display to finish moving'''
+        driver = FakeDriver()
+        moving = threading.Event()
+        moved = threading.Event()
+        def render(n, stale):
+            moving.set()
+            moved.wait()
+            return set_display(driver, self.pages[n - 1], stale)
+        scheduler = RenderScheduler(render)
+        scheduler.start()
+        scheduler.submit(1)
+        self.assertTrue(moving.wait(5))
+        for n in range(2, 5):
+            scheduler.submit(n)
+        moved.set()
+        scheduler.wait()
+        # page 1 was out of date before its first row was sent
+        self.assertEqual(self.sent_rows(driver), [(0, 4), (1, 4), (2, 4), (3, 4)])
+        self.assertEqual(scheduler.stats(), {'frames': 1, 'dropped': 3})
+
+
 class TestDriverPi(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -133,6 +432,12 @@ class TestDriverPi(unittest.TestCase):
         # send rows
         self.send_message([4], comms.CMD_GET_ROWS)
 
+        # receive the version query
+        self.assertEqual(self.get_message()[0], comms.CMD_SEND_VERSION)
+
+        # send the version
+        self.send_message([comms.VERSION_SEND_PAGE], comms.CMD_SEND_VERSION)
+
     @classmethod
     def tearDownClass(cls):
         cls._driver.join()
@@ -150,6 +455,18 @@ class TestConvert(unittest.TestCase):
         pages = math.ceil(lines / 4.0)
         self.assertEqual(pages, 4)
 
+    def test_convert_brf_chunks(self):
+        '''rows split across chunk boundaries convert the same'''
+        brf_file = '../test-books/brf_test.BRF'
+        native_file = '../test-books/brf_test.canute'
+        convert.convert_brf(40, 4, brf_file, native_file, remove=False)
+        with open(native_file, 'rb') as fh:
+            expected = fh.read()
+        with mock.patch.object(convert, 'BRF_CHUNK_SIZE', 7):
+            convert.convert_brf(40, 4, brf_file, native_file, remove=False)
+        with open(native_file, 'rb') as fh:
+            self.assertEqual(fh.read(), expected)
+
     def test_convert_pef(self):
         book_name = 'pef_test'
         book_path = '../test-books/'
@@ -166,6 +483,125 @@ class TestConvert(unittest.TestCase):
         alphas = ''.join(alphas).lower()
         self.assertEqual(alphas[0:40], 'the quickbrownfoxjumpedoverlazydog.000  ')
 
+    def test_can_convert(self):
+        self.assertTrue(convert.can_convert('/books/a.PEF'))
+        self.assertTrue(convert.can_convert('a.brf'))
+        self.assertTrue(convert.can_convert('a.txt'))
+        self.assertFalse(convert.can_convert('a.canute'))
+        self.assertFalse(convert.can_convert('pef'))
+
+    def test_convert_pef_broken(self):
+        '''a pef that fails to parse part way through leaves no native file'''
+        pef_file = '/tmp/broken_test.pef'
+        native_file = '/tmp/broken_test.canute'
+        with open(pef_file, 'w') as fh:
+            fh.write('<pef><body><volume><section><page><row>\xe2\xa0\x81</row></page><page>')
+        self.assertFalse(convert.convert_pef(40, 4, pef_file, native_file, remove=True))
+        self.assertFalse(os.path.exists(native_file))
+        self.assertFalse(os.path.exists(pef_file))
+
+    def test_convert_pef_unwritable(self):
+        '''a native file that can't be opened is logged, not raised'''
+        native_file = '/tmp/no_such_directory/pef_test.canute'
+        convert.convert_pef(40, 4, '../test-books/pef_test.pef', native_file, remove=False)
+        self.assertFalse(os.path.exists(native_file))
+
+    def test_convert_txt(self):
+        txt_file = '/tmp/txt_test.txt'
+        native_file = '/tmp/txt_test.canute'
+        with open(txt_file, 'w') as fh:
+            fh.write('the quick brown fox\n\njumped over\fthe lazy dog\n')
+        convert.convert_txt(12, 4, txt_file, native_file)
+        self.assertFalse(os.path.exists(txt_file))
+        content = BookFile_List(native_file, 12, 4)
+        self.assertEqual(len(content), 8)
+        alphas = [''.join(utility.pin_nums_to_alphas(row)).rstrip()
+                  for row in content[0:8]]
+        self.assertEqual(alphas, ['THE QUICK', 'BROWN FOX', '', 'JUMPED OVER',
+                                  'THE LAZY DOG', '', '', ''])
+        os.remove(native_file)
+
+    def test_native_header(self):
+        book_path = '../test-books/'
+        brf_file = book_path + 'brf_break_test.brf'
+        native_file = book_path + 'brf_break_test.canute'
+        convert.convert_brf(40, 4, brf_file, native_file, remove=False)
+        content = BookFile_List(native_file, 40, 4)
+        self.assertTrue(content.header.complete)
+        self.assertEqual(content.header.pages, 4)
+        self.assertEqual(content.header.title, 'brf break test')
+        self.assertEqual(content.header.source_hash, utility.file_hash(brf_file))
+        self.assertEqual(len(content), 16)
+        # rows past the end are blank rather than the page index
+        self.assertEqual(content[16:17], [(0,) * 40])
+        self.assertRaises(BookFormatError, BookFile_List, native_file, 40, 9)
+        self.assertRaises(BookFormatError, BookFile_List, native_file, 28)
+
+    def test_source_hash(self):
+        '''a hash ending in a zero byte is read back whole'''
+        from StringIO import StringIO
+        for source_hash in ['ab' * 19 + '00', '00' * 19 + 'ab', '']:
+            fh = StringIO()
+            book_format.BookWriter(fh, 40, 4, source_hash=source_hash).close()
+            self.assertEqual(book_format.read_header(fh).source_hash, source_hash)
+
+    def test_navigation(self):
+        out_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, out_dir)
+        native_file = os.path.join(out_dir, 'nav_test.canute')
+        for compress in (False, True):
+            with book_format.open_new(native_file) as fh:
+                writer = book_format.BookWriter(fh, 40, 4, compress=compress)
+                writer.mark(book_format.NAV_SECTION)
+                writer.mark(book_format.NAV_VOLUME)
+                for row in range(10):
+                    if row == 9:
+                        writer.mark(book_format.NAV_HEADING)
+                    writer.write_row('\x01' * 40)
+                writer.mark(book_format.NAV_SECTION)
+                writer.close()
+            content = BookFile_List(native_file, 40, 4)
+            self.assertEqual(content.navigation(), [0, 2])
+            self.assertEqual(len(content), 12)
+        # pefs mark their volumes and sections
+        native_file = os.path.join(out_dir, 'pef_test.canute')
+        convert.convert_pef(40, 4, '../test-books/pef_test.pef', native_file, remove=False)
+        self.assertEqual(BookFile_List(native_file, 40, 4).navigation(), [0])
+        # and centred lines in brfs are headings
+        self.assertTrue(convert._is_heading('                ,ab/ract\r', 40))
+        self.assertFalse(convert._is_heading('                           #ab', 40))
+        # but not the indented lines of a paragraph that fill the row
+        self.assertFalse(convert._is_heading('  ' + 'a' * 37 + '\r', 40))
+        brf_file = os.path.join(out_dir, 'nav_test.brf')
+        with open(brf_file, 'w') as fh:
+            fh.write('  ' + 'a' * 37 + '\n\n  ' + 'b' * 36 + '\n')
+        convert.convert_brf(40, 4, brf_file, native_file)
+        self.assertEqual(BookFile_List(native_file, 40, 4).navigation(), [])
+        # only those after a blank line or at the top of a page, even the
+        # last line of one with no line ending
+        with open(brf_file, 'w') as fh:
+            fh.write('text\r\n' * 2 + ' ' * 16 + ',ab/ract\r\n' + 'text\r\n\r\n'
+                     + ' ' * 17 + ',ab/ract')
+        convert.convert_brf(40, 4, brf_file, native_file)
+        self.assertEqual(BookFile_List(native_file, 40, 4).navigation(), [1])
+
+    def test_convert_compressed(self):
+        '''compressed books read the same as uncompressed ones'''
+        pef_file = '../test-books/pef_test.pef'
+        out_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, out_dir)
+        native_file = os.path.join(out_dir, 'pef_test.canute')
+        compressed_file = os.path.join(out_dir, 'pef_test_compressed.canute')
+        convert.convert_pef(40, 4, pef_file, native_file, remove=False)
+        convert.convert_pef(40, 4, pef_file, compressed_file, remove=False, compress=True)
+        content = BookFile_List(native_file, 40, 4)
+        compressed = BookFile_List(compressed_file, 40, 4)
+        self.assertTrue(compressed.header.compressed)
+        self.assertEqual(len(compressed), len(content))
+        self.assertEqual(compressed[0:len(content)], content[0:len(content)])
+        self.assertEqual(compressed[7:11], content[7:11])
+        self.assertLess(os.path.getsize(compressed_file), os.path.getsize(native_file))
+
     def test_convert_brf(self):
         book_name = 'brf_test'
         book_path = '../test-books/'
@@ -196,6 +632,252 @@ class TestConvert(unittest.TestCase):
         self.assertEqual(alphas, brf_content)
 
 
+convert_job = convert.convert_job
+def slow_convert_job(job):
+    time.sleep(0.5)
+    return convert_job(job)
+
+
+class TestConvertLibrary(unittest.TestCase):
+    def setUp(self):
+        self._library = tempfile.mkdtemp() + '/'
+        for book in utility.find_files('../test-books', ('brf', 'pef')):
+            shutil.copy(book, self._library)
+
+    def test_convert_library(self):
+        native_files = convert_library(40, 4, self._library, workers=2)
+        self.assertEqual(native_files, sorted(native_files))
+        self.assertEqual(len(native_files), 3)
+        self.assertEqual(utility.find_files(self._library, ('brf', 'pef')), [])
+        for native_file in native_files:
+            self.assertTrue(os.path.exists(native_file))
+
+    def test_conversion_pool(self):
+        '''once the pool is started conversions use it rather than forking'''
+        main.start_pool(2)
+        try:
+            with mock.patch('multiprocessing.Pool') as mock_pool:
+                native_files = convert_library(40, 4, self._library)
+                self.assertFalse(mock_pool.called)
+            self.assertEqual(len(native_files), 3)
+        finally:
+            main.conversion_pool.terminate()
+            main.conversion_pool = None
+
+    def test_convert_library_same_name(self):
+        '''books that would be converted to the same file are converted once'''
+        os.mkdir(self._library + 'more')
+        shutil.copy('../test-books/brf_test.BRF', self._library + 'pef_test.brf')
+        shutil.copy('../test-books/brf_test.BRF', self._library + 'more/pef_test.brf')
+        native_file = self._library + 'pef_test.canute'
+        native_files = convert_library(40, 4, self._library)
+        self.assertEqual(native_files.count(native_file), 1)
+        # the first in filename order is converted and the others are left
+        self.assertFalse(os.path.exists(self._library + 'more/pef_test.brf'))
+        self.assertEqual(len(BookFile_List(native_file, 40, 4)), 248 * 4)
+        self.assertTrue(os.path.exists(self._library + 'pef_test.brf'))
+        self.assertTrue(os.path.exists(self._library + 'pef_test.pef'))
+
+    def test_convert_library_broken(self):
+        '''a pef that fails to parse isn't reported as converted'''
+        convert_library(40, 4, self._library)
+        pef_file = self._library + 'broken_test.pef'
+        with open(pef_file, 'w') as fh:
+            fh.write('<pef><body><volume><section><page><row>\xe2\xa0\x81</row></page><page>')
+        native_file = self._library + 'broken_test.canute'
+        self.assertEqual(convert_library(40, 4, self._library), [])
+        self.assertFalse(os.path.exists(native_file))
+        self.assertFalse(os.path.exists(search.search_filename(native_file)))
+        self.assertNotIn('broken_test.canute', manifest.read(self._library))
+
+    def test_convert_library_cached(self):
+        '''an unchanged book is not converted a second time'''
+        convert_library(40, 4, self._library)
+        native_file = self._library + 'pef_test.canute'
+        os.utime(native_file, (0, 0))
+        shutil.copy('../test-books/pef_test.pef', self._library)
+        native_files = convert_library(40, 4, self._library)
+        self.assertEqual(native_files, [native_file])
+        self.assertEqual(os.path.getmtime(native_file), 0)
+        self.assertEqual(utility.find_files(self._library, ('pef',)), [])
+        # compressing the pages needs a new conversion
+        shutil.copy('../test-books/pef_test.pef', self._library)
+        convert_library(40, 4, self._library, compress=True)
+        self.assertNotEqual(os.path.getmtime(native_file), 0)
+        self.assertTrue(BookFile_List(native_file, 40, 4).header.compressed)
+        # different dimensions need a new conversion
+        os.utime(native_file, (0, 0))
+        shutil.copy('../test-books/pef_test.pef', self._library)
+        convert_library(40, 9, self._library)
+        self.assertNotEqual(os.path.getmtime(native_file), 0)
+
+    def test_library_index(self):
+        '''a book in an unchanged directory isn't opened again'''
+        native_files = convert_library(40, 4, self._library)
+        os.utime(self._library, (1000, 1000))
+        index_file = os.path.join(tempfile.mkdtemp(), 'library.json')
+        index = LibraryIndex(self._library, index_file)
+        self.assertEqual(sorted(index.find_files(('canute',))), native_files)
+        book = index.book(native_files[0], 40, 4)
+        index.write(native_files)
+        index = LibraryIndex(self._library, index_file)
+        self.assertEqual(sorted(index.find_files(('canute',))), native_files)
+        self.assertEqual(index.changed_dirs, set())
+        with mock.patch('mmap.mmap') as mock_mmap:
+            indexed = index.book(native_files[0], 40, 4)
+            self.assertEqual(len(indexed), len(book))
+            self.assertEqual(indexed.title, book.title)
+            self.assertFalse(mock_mmap.called)
+        self.assertEqual(indexed[0:1], book[0:1])
+        # dimensions are still checked
+        self.assertRaises(BookFormatError, index.book, native_files[0], 40, 9)
+        # even if the book is rewritten without the directory changing
+        other_file = os.path.join(os.path.dirname(index_file), 'other.canute')
+        convert.convert_pef(40, 9, '../test-books/pef_test.pef', other_file, remove=False)
+        shutil.copyfile(other_file, native_files[0])
+        os.utime(self._library, (1000, 1000))
+        index = LibraryIndex(self._library, index_file)
+        index.find_files(('canute',))
+        self.assertEqual(index.changed_dirs, set())
+        # which is found when it is read rather than opening every book
+        with mock.patch('book_format.read_header') as mock_read_header:
+            indexed = index.book(native_files[0], 40, 4)
+            self.assertFalse(mock_read_header.called)
+        self.assertRaises(BookFormatError, indexed.__getslice__, 0, 1)
+        shutil.rmtree(os.path.dirname(index_file))
+
+    def test_non_utf8_filename(self):
+        '''books whose filenames aren't utf-8 are indexed and kept in the manifest'''
+        shutil.copy('../test-books/pef_test.pef', self._library + 'Caf\xe9.pef')
+        native_file = self._library + 'Caf\xe9.canute'
+        native_files = convert_library(40, 4, self._library)
+        self.assertIn(native_file, native_files)
+        self.assertIn('Caf\xe9.canute', manifest.read(self._library))
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir)
+        index_file = os.path.join(index_dir, 'library.json')
+        index = LibraryIndex(self._library, index_file)
+        index.find_files(('canute',))
+        book = index.book(native_file, 40, 4)
+        index.write(native_files)
+        index = LibraryIndex(self._library, index_file)
+        self.assertEqual(sorted(index.find_files(('canute',))), native_files)
+        self.assertEqual(index.changed_dirs, set())
+        self.assertEqual(len(index.book(native_file, 40, 4)), len(book))
+
+    def test_search(self):
+        native_files = convert_library(40, 4, self._library)
+        native_file = self._library + 'brf_test.canute'
+        self.assertTrue(os.path.exists(search.search_filename(native_file)))
+        index = search.SearchIndex()
+        index.update(native_files, 40, 4)
+        query = utility.alphas_to_pin_nums(',bri/ol ,brl')
+        results = index.search(query)
+        self.assertEqual(results[:2], [(native_file, 0), (native_file, 1)])
+        self.assertEqual(set(f for f, page in results), set([native_file]))
+        self.assertEqual(index.search(utility.alphas_to_pin_nums('xyzzy')), [])
+        # books that have gone are forgotten
+        native_files.remove(native_file)
+        index.update(native_files, 40, 4)
+        self.assertEqual(index.search(query), [])
+        # books still being converted aren't indexed until they are done
+        growing_file = self._library + 'growing.canute'
+        with open(growing_file, 'wb') as fh:
+            writer = book_format.BookWriter(fh, 40, 4)
+            writer.write_row(str(bytearray(utility.alphas_to_pin_nums('xyzzy'))))
+            fh.flush()
+            index.update(native_files + [growing_file], 40, 4)
+            self.assertFalse(os.path.exists(search.search_filename(growing_file)))
+            self.assertEqual(index.search(utility.alphas_to_pin_nums('xyzzy')), [])
+            writer.close()
+        index.update(native_files + [growing_file], 40, 4)
+        self.assertEqual(index.search(utility.alphas_to_pin_nums('xyzzy')),
+                         [(growing_file, 0)])
+
+    def test_search_thread(self):
+        '''the library is searched off the dispatch path'''
+        native_files = convert_library(40, 4, self._library)
+        native_file = self._library + 'brf_test.canute'
+        r = actions.Reducers()
+        state = initial_state.copy(display = frozendict({'width': 40, 'height': 4}))
+        state = r.add_books(state, [BookFile_List(f, 40, 4) for f in native_files])
+        state = r.search(state, utility.alphas_to_pin_nums(',bri/ol ,brl'))
+        store.store.dispatch(actions.actions.init(state))
+        start_search(store.store.get_state()).join()
+        state = store.store.get_state()
+        self.assertEqual(state['search']['searching'], False)
+        self.assertEqual(state['search']['results'][:2], ((native_file, 0), (native_file, 1)))
+        self.assertEqual(state['filenames'][state['location']], native_file)
+        # results for a query that has been replaced are dropped
+        state = r.search(state, utility.alphas_to_pin_nums('xyzzy'))
+        store.store.dispatch(actions.actions.init(state))
+        start_search(state.copy(search = state['search'].copy(query = (1,)))).join()
+        self.assertEqual(store.store.get_state()['search']['searching'], 'start')
+        # a page is searched for the words on its first row
+        state = r.search_page(r.go_to_book(state, 0), None)
+        store.store.dispatch(actions.actions.init(state))
+        start_search(state).join()
+        results = store.store.get_state()['search']['results']
+        self.assertIn((state['filenames'][0], 0), results)
+
+    def test_wipe_library(self):
+        '''replacing the library doesn't remove text files that aren't books'''
+        native_files = convert_library(40, 4, self._library)
+        readme = self._library + 'README.txt'
+        with open(readme, 'w') as fh:
+            fh.write('not a book')
+        wipe_library(self._library, native_files[:1])
+        self.assertEqual(sorted(os.listdir(self._library)),
+                         sorted(['README.txt', manifest.manifest_file,
+                                 os.path.basename(native_files[0]),
+                                 os.path.basename(search.search_filename(native_files[0]))]))
+
+    def test_sync_library(self):
+        '''a book whose old native file is for other dimensions is added once converted'''
+        convert_library(40, 9, self._library)
+        shutil.copy('../test-books/pef_test.pef', self._library)
+        native_file = self._library + 'pef_test.canute'
+        state = initial_state.copy(display = frozendict({'width': 40, 'height': 4}))
+        store.store.dispatch(actions.actions.init(state))
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir)
+        # make sure the old native file is still there when it is looked at
+        with mock.patch('convert.convert_job', slow_convert_job):
+            sync_library(state, self._library, index_file=os.path.join(index_dir, 'library.json'))
+        self.assertNotIn(native_file, store.store.get_state()['filenames'])
+        finish_conversions(wait=True)
+        state = store.store.get_state()
+        self.assertIn(native_file, state['filenames'])
+        book = state['books'][state['filenames'].index(native_file)]
+        self.assertEqual(book.header.height, 4)
+
+    def test_open_while_converting(self):
+        '''a book can be read while it is still being written'''
+        self.open_while_converting(compress=False)
+
+    def test_open_while_converting_compressed(self):
+        self.open_while_converting(compress=True)
+
+    def open_while_converting(self, compress):
+        native_file = self._library + 'growing.canute'
+        with open(native_file, 'wb') as fh:
+            book = BookFile_List(native_file, 40, 4)
+            self.assertEqual(len(book), 0)
+            writer = book_format.BookWriter(fh, 40, 4, compress=compress)
+            for row in range(4):
+                writer.write_row('\x01' * 40)
+            fh.flush()
+            self.assertEqual(len(book), 4)
+            self.assertEqual(book[0:1], [(1,) * 40])
+            writer.write_row('\x02' * 40)
+            writer.close()
+        self.assertEqual(len(book), 8)
+        self.assertEqual(book[4:5], [(2,) * 40])
+
+    def tearDown(self):
+        shutil.rmtree(self._library)
+
+
 class TestActions(unittest.TestCase):
     def test_add_books(self):
         self.assertEqual(len(initial_state['books']), 0)
@@ -227,6 +909,46 @@ class TestActions(unittest.TestCase):
         state = r.remove_books(state, [data.filename])
         self.assertEqual(len(initial_state['books']), 0)
         self.assertEqual(len(state['books']), 0)
+        # the first, last and middle books, and one that isn't there
+        books = []
+        for filename in 'abcde':
+            book = mock.MagicMock()
+            book.filename = filename
+            books.append(book)
+        state = r.add_books(initial_state, books)
+        state = r.remove_books(state, ['e', 'a', 'c', 'x'])
+        self.assertEqual(state['filenames'], ('b', 'd'))
+        self.assertEqual([b.filename for b in state['books']], ['b', 'd'])
+        self.assertEqual(len(state['library']['data']), 2)
+
+    def test_add_books_incremental(self):
+        '''books are kept in order and only new titles are rendered'''
+        r = actions.Reducers()
+        books = []
+        for n in range(1000):
+            data = mock.MagicMock()
+            data.filename = '/books/%04d.canute' % (n * 2)
+            data.title = None
+            books.append(data)
+        state = r.add_books(initial_state, books[::-1])
+        self.assertEqual(state['filenames'], tuple(sorted(b.filename for b in books)))
+        new = mock.MagicMock()
+        new.filename = '/books/0011.canute'
+        new.title = None
+        again = mock.MagicMock()
+        again.filename = books[0].filename
+        again.title = None
+        with mock.patch('actions.get_title', wraps=actions.get_title) as get_title:
+            state = r.add_books(state, [new, again])
+            self.assertEqual(get_title.call_count, 2)
+        self.assertEqual(len(state['books']), 1001)
+        self.assertIs(state['books'][6], new)
+        # a book that is already there is replaced
+        self.assertIs(state['books'][0], again)
+        self.assertEqual(state['library']['data'][6][:4], utility.alphas_to_pin_nums('0011'))
+        state = r.remove_books(state, [new.filename, books[1].filename])
+        self.assertEqual(len(state['library']['data']), 999)
+        self.assertEqual(state['filenames'][:2], (books[0].filename, books[2].filename))
 
     def test_book_navigation(self):
         self.assertEqual(len(initial_state['books']), 0)
@@ -236,27 +958,302 @@ class TestActions(unittest.TestCase):
             for page in pages:
                 fh.write(bytearray(page))
 
-        bookfile = BookFile_List('/tmp/book', 40)
+        bookfile = BookFile_List('/tmp/book', 40, 9)
         state = r.add_books(initial_state, [bookfile])
         state = r.go_to_book(state, 0)
 
         self.assertEqual(state['location'], 0)
-        self.assertEqual(state['books'][0]['page'], 0)
+        self.assertEqual(actions.get_book_page(state, 0), 0)
 
         # check we can't go backwards from page 0
         state = r.previous_page(state, None)
-        self.assertEqual(state['books'][0]['page'], 0)
+        self.assertEqual(actions.get_book_page(state, 0), 0)
 
         # check we can go forwards from page 0
         state = r.next_page(state, None)
-        self.assertEqual(state['books'][0]['page'], 1)
+        self.assertEqual(actions.get_book_page(state, 0), 1)
 
         # go fowards too many times
         for i in range(10):
             state = r.next_page(state, None)
 
         # and check we're on the last page
-        self.assertEqual(state['books'][0]['page'], 7)
+        self.assertEqual(actions.get_book_page(state, 0), 7)
+
+    def test_section_navigation(self):
+        r = actions.Reducers()
+        data = mock.MagicMock()
+        data.filename = 'test'
+        data.__len__.return_value = 90
+        state = r.add_books(initial_state, [data])
+        state = r.go_to_book(state, 0)
+        # nothing until the marks have been read
+        self.assertEqual(actions.get_book_page(r.next_section(state, None), 0), 0)
+        state = r.set_navigation(state, ('test', [0, 3, 7]))
+        state = r.next_section(state, None)
+        self.assertEqual(actions.get_book_page(state, 0), 3)
+        state = r.next_page(state, None)
+        state = r.previous_section(state, None)
+        self.assertEqual(actions.get_book_page(state, 0), 3)
+        state = r.previous_section(state, None)
+        self.assertEqual(actions.get_book_page(state, 0), 0)
+        state = r.previous_section(state, None)
+        self.assertEqual(actions.get_book_page(state, 0), 0)
+        state = r.skip_pages(state, 8)
+        state = r.next_section(state, None)
+        self.assertEqual(actions.get_book_page(state, 0), 8)
+        self.assertFalse(data.navigation.called)
+        # and are read again if the book is replaced
+        self.assertNotIn('test', r.add_books(state, [data])['navigation'])
+        self.assertNotIn('test', r.remove_books(state, ['test'])['navigation'])
+
+    def test_load_navigation(self):
+        '''a book's marks are put in the state when it is first shown'''
+        book_file = '../test-books/pef_test.pef'
+        out_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, out_dir)
+        native_file = os.path.join(out_dir, 'pef_test.canute')
+        convert.convert_pef(40, 9, book_file, native_file, remove=False)
+        r = actions.Reducers()
+        state = r.add_books(initial_state, [BookFile_List(native_file, 40, 9)])
+        store.store.dispatch(actions.actions.init(r.go_to_book(state, 0)))
+        driver = mock.MagicMock()
+        driver.set_page.return_value = True
+        main.render(driver, store.store.get_state())
+        main.open_book(None)
+        self.assertEqual(store.store.get_state()['navigation'].get(native_file), (0,))
+
+    def test_search_results(self):
+        r = actions.Reducers()
+        books = []
+        for filename in ('a', 'b'):
+            data = mock.MagicMock()
+            data.filename = filename
+            data.__len__.return_value = 90
+            books.append(data)
+        state = r.add_books(initial_state, books)
+        state = r.search(state, (1, 2))
+        self.assertEqual(state['search']['searching'], 'start')
+        state = r.search_results(state, [('a', 3), ('b', 5)])
+        self.assertEqual(state['search']['searching'], False)
+        self.assertEqual(state['location'], 0)
+        self.assertEqual(actions.get_book_page(state, 0), 3)
+        state = r.next_search_result(state, None)
+        self.assertEqual(state['location'], 1)
+        self.assertEqual(actions.get_book_page(state, 1), 5)
+        # back round to the first
+        state = r.next_search_result(state, None)
+        self.assertEqual(state['location'], 0)
+
+    def test_search_entry(self):
+        '''a query is typed a cell at a time with the buttons as dots'''
+        r = actions.Reducers()
+        state = r.go_to_search(initial_state, None)
+        self.assertEqual(state['location'], 'search')
+        for dot in (1, 2, 4, 2):
+            state = r.type_dot(state, dot)
+        self.assertEqual(state['search']['cell'], 9)
+        state = r.type_cell(state, None)
+        state = r.type_cell(state, None)
+        state = r.type_dot(state, 3)
+        state = r.delete_cell(state, None)
+        state = r.delete_cell(state, None)
+        state = r.type_dot(state, 1)
+        state = r.type_dot(state, 2)
+        self.assertEqual(actions.typed_query(state['search']), (9, 3))
+        state = r.search_typed(state, None)
+        self.assertEqual(state['search']['query'], (9, 3))
+        self.assertEqual(state['search']['searching'], 'start')
+        # which is shown with the search status below it
+        driver = mock.MagicMock()
+        driver.set_page.return_value = True
+        main.render(driver, state.copy(search = state['search'].copy(searching = False)))
+        rows = driver.set_page.call_args[0][0]
+        self.assertEqual(len(rows), 9)
+        self.assertEqual(list(rows[1]), [9, 3] + [0] * 38)
+        self.assertEqual(''.join(utility.pin_nums_to_alphas(rows[2])).strip(), 'NOT FOUND')
+        # a new search starts afresh
+        state = r.go_to_search(state, None)
+        self.assertEqual(actions.typed_query(state['search']), ())
+        self.assertEqual(state['search']['query'], ())
+
+    def test_search_page(self):
+        '''R searches for the first row of the page, then goes through the results'''
+        r = actions.Reducers()
+        pages = utility.test_book((40, 9))
+        with open('/tmp/book', 'w') as fh:
+            for page in pages:
+                fh.write(bytearray(page))
+        bookfile = BookFile_List('/tmp/book', 40, 9)
+        state = initial_state.copy(display = frozendict({'width': 40, 'height': 9}))
+        state = r.add_books(state, [bookfile])
+        state = r.go_to_book(state, 0)
+        state = r.next_page(state, None)
+        state = r.search_page(state, None)
+        self.assertEqual(state['search']['page'], ('/tmp/book', 1))
+        self.assertEqual(state['search']['searching'], 'start')
+        state = r.search_results(state, [('/tmp/book', 1), ('/tmp/book', 3)])
+        state = r.search_page(state, None)
+        self.assertEqual(actions.get_book_page(state, 0), 3)
+        # somewhere else it searches again
+        state = r.next_page(state, None)
+        state = r.search_page(state, None)
+        self.assertEqual(state['search']['page'], ('/tmp/book', 4))
+        self.assertEqual(state['search']['results'], ())
+        # the row is read by the search
+        self.assertEqual(first_row(state, '/tmp/book', 4), (36,) * 40)
+        self.assertEqual(first_row(state, '/tmp/other', 4), ())
+        # and typing a query replaces it
+        state = r.search(state, (1, 2))
+        self.assertEqual(state['search']['page'], None)
+
+class TestPersistentMap(unittest.TestCase):
+    def test_set_remove(self):
+        empty = PersistentMap()
+        m = empty
+        for n in range(2000):
+            m = m.set('book%d' % n, n)
+        self.assertEqual(len(m), 2000)
+        self.assertEqual(len(empty), 0)
+        changed = m.set('book5', 50)
+        self.assertEqual((m['book5'], changed['book5']), (5, 50))
+        self.assertEqual(len(changed), 2000)
+        for n in range(0, 2000, 2):
+            changed = changed.remove('book%d' % n)
+        self.assertEqual(len(changed), 1000)
+        self.assertNotIn('book4', changed)
+        self.assertEqual(changed.get('book7'), 7)
+        self.assertIs(changed.remove('missing'), changed)
+        self.assertEqual(m, dict(('book%d' % n, n) for n in range(2000)))
+        self.assertRaises(KeyError, lambda: m['missing'])
+
+    def test_collisions(self):
+        class Key(str):
+            def __hash__(self):
+                return 7
+        keys = [Key('a'), Key('b'), Key('c')]
+        m = PersistentMap((key, n) for n, key in enumerate(keys)).set('d', 3)
+        self.assertEqual([m.get(key) for key in keys], [0, 1, 2])
+        m = m.remove(keys[0]).remove(keys[1])
+        self.assertEqual(m, {keys[2]: 2, 'd': 3})
+
+
+class TestStore(unittest.TestCase):
+    def test_reducer(self):
+        state = initial_state.copy(location = 'library')
+        self.assertEqual(store.reducer(state, actions.actions.go_to_menu())['location'], 'menu')
+        self.assertIs(store.reducer(state, {'type': 'no_such_action'}), state)
+
+    def test_instrument(self):
+        store.instrument()
+        try:
+            for _ in range(3):
+                store.reducer(initial_state, actions.actions.go_to_menu())
+            store.reducer(initial_state, actions.actions.trigger())
+            stats = store.stats()
+            self.assertEqual(stats['go_to_menu']['count'], 3)
+            self.assertEqual(stats['trigger']['count'], 1)
+            self.assertGreaterEqual(stats['trigger']['seconds'], 0)
+            store.dump_stats()
+        finally:
+            store.instrument(False)
+        self.assertEqual(store.stats(), {})
+
+
+class TestInitialState(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._state_file = os.path.join(self._dir, 'state.pkl')
+
+    def test_state_writer(self):
+        '''changes close together are written once'''
+        writer = StateWriter(0.1, self._state_file)
+        for value in ('a', 'b', 'c'):
+            writer.schedule(initial_state.copy(update_ui = value))
+        self.assertFalse(os.path.exists(self._state_file))
+        time.sleep(0.5)
+        self.assertEqual(writer.writes, 1)
+        self.assertEqual(read_state(self._state_file)['update_ui'], 'c')
+        writer.schedule(initial_state.copy(update_ui = 'd'))
+        writer.flush()
+        self.assertEqual(writer.writes, 2)
+        self.assertEqual(read_state(self._state_file)['update_ui'], 'd')
+        # nothing left to write
+        writer.flush()
+        self.assertEqual(writer.writes, 2)
+
+    def restored(self, state):
+        '''the state read back with the books added again'''
+        data = list(state['books'])
+        state = read_state(self._state_file, self._state_file + '.pkl')
+        self.assertEqual(state['books'], ())
+        return actions.Reducers().add_books(state, data)
+
+    def test_read_write(self):
+        '''only positions, location and flags are saved'''
+        book_file = os.path.join(self._dir, 'book.canute')
+        with open(book_file, 'w') as fh:
+            fh.write('\0' * 40 * 90)
+        other = mock.MagicMock()
+        other.filename = os.path.join(self._dir, 'another.canute')
+        r = actions.Reducers()
+        state = r.add_books(initial_state, [BookFile_List(book_file, 40, 9), other])
+        state = r.go_to_book(state, 1)
+        state = r.skip_pages(state, 3)
+        state = state.copy(update_ui = 'in progress')
+        write_state(state, self._state_file)
+        with open(self._state_file) as fh:
+            self.assertNotIn('BookFile_List', fh.read())
+        state = self.restored(state)
+        self.assertEqual(state['location'], 1)
+        self.assertEqual(actions.get_book_page(state, 1), 3)
+        self.assertEqual(actions.get_book_page(state, 0), 0)
+        self.assertEqual(state['update_ui'], 'in progress')
+        self.assertEqual(state['positions'], {book_file: 3})
+
+    def test_migrate(self):
+        '''pickled state files are migrated'''
+        book_file = os.path.join(self._dir, 'book.canute')
+        with open(book_file, 'w') as fh:
+            fh.write('\0' * 40 * 90)
+        book = BookFile_List(book_file, 40, 9)
+        legacy = dict(initial_state, location = 0, books = ({'data': book, 'page': 1},))
+        del legacy['positions']
+        del legacy['navigation']
+        del legacy['filenames']
+        with open(self._state_file + '.pkl', 'wb') as fh:
+            pickle.dump(frozendict(legacy), fh)
+        state = initial_state.copy(books = (book,))
+        state = self.restored(state)
+        self.assertEqual(state['location'], 0)
+        self.assertEqual(actions.get_book_page(state, 0), 1)
+        # version 2 stored filenames as utf-8
+        utf8_file = os.path.join(self._dir, 'Caf\xc3\xa9.canute')
+        with open(self._state_file, 'w') as fh:
+            json.dump({'version': 2, 'location': 'library', 'update_ui': False,
+                       'pages': {utf8_file: 2}}, fh)
+        self.assertEqual(read_state(self._state_file)['positions'], {utf8_file: 2})
+
+    def test_non_utf8_filename(self):
+        '''filenames that aren't utf-8 are saved as they are'''
+        book_file = os.path.join(self._dir, 'Caf\xe9.canute')
+        with open(book_file, 'w') as fh:
+            fh.write('\0' * 40 * 90)
+        r = actions.Reducers()
+        state = r.add_books(initial_state, [BookFile_List(book_file, 40, 9)])
+        state = r.go_to_book(state, 0)
+        state = r.skip_pages(state, 2)
+        writer = StateWriter(0.1, self._state_file)
+        writer.schedule(state)
+        writer.flush()
+        self.assertEqual(writer.writes, 1)
+        state = self.restored(state)
+        self.assertEqual(state['location'], 0)
+        self.assertEqual(state['positions'], {book_file: 2})
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
 
 if __name__ == '__main__':
     config = config_loader.load()
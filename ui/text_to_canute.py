@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 import argparse
-from utility import alphas_to_pin_nums
+from convert import convert_txt
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -10,16 +10,9 @@ parser = argparse.ArgumentParser(description="convert from plain text to canute
 
 parser.add_argument('--in', action='store', dest='in_file', help="text file to convert", required=True)
 parser.add_argument('--out', action='store', dest='out_file', help="canute file to write", required=True)
+parser.add_argument('--width', action='store', dest='width', help="cells per row", default=40, type=int)
+parser.add_argument('--height', action='store', dest='height', help="rows per page", default=9, type=int)
 
 args = parser.parse_args()
 
-with open(args.in_file) as fh:
-    lines = fh.readlines()
-
-with open(args.out_file, 'w') as fh:
-    for line in lines:
-        line = line.strip()
-        pin_nums = alphas_to_pin_nums(line)
-        joined = ','.join([str(x) for x in pin_nums])
-        fh.write(joined + "\n")
-
+convert_txt(args.width, args.height, args.in_file, args.out_file, remove=False)
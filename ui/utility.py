@@ -9,6 +9,7 @@ import os
 import re
 import logging
 import functools
+import hashlib
 import tarfile
 import shutil
 from datetime import datetime
@@ -17,6 +18,28 @@ log = logging.getLogger(__name__)
 class FormfeedConversionException(Exception): pass
 class LinefeedConversionException(Exception): pass
 
+# mapping from http://en.wikipedia.org/wiki/Braille_ASCII#Braille_ASCII_values
+BRAILLE_ASCII = " A1B'K2L@CIF/MSP\"E3H9O6R^DJG>NTQ,*5<-U8V.%[$+X!&;:4\\0Z7(_?W]#Y)="
+
+def _make_alpha_table():
+    '''
+    build a 256 entry translation table from bytes to pin numbers for use
+    with `str.translate`. lower case is mapped the same as upper case and
+    anything that isn't braille ascii maps to 0 (a blank cell)
+    '''
+    table = []
+    for i in range(256):
+        alpha = chr(i).upper()
+        if alpha in BRAILLE_ASCII:
+            table.append(chr(BRAILLE_ASCII.index(alpha)))
+        else:
+            table.append(chr(0))
+    return ''.join(table)
+
+alpha_to_pin_table = _make_alpha_table()
+# the bytes that have an entry in alpha_to_pin_table, used to count unknowns
+alpha_table_chars = BRAILLE_ASCII + BRAILLE_ASCII.lower()
+
 def find_ui_update(config):
     '''
     recursively look for firmware in the usb_dir,
@@ -43,41 +66,69 @@ def find_files(directory, extensions):
                     break
     return matches
 
+def file_hash(filename, chunk_size=64 * 1024):
+    '''returns the hex sha1 digest of a file's contents'''
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def write_atomically(filename, data):
+    '''
+    write data to a temporary file next to filename and rename it into place,
+    so a crash or power cut leaves either the old or the new file but never a
+    partly written one
+    '''
+    tmp_file = filename + '.tmp'
+    with open(tmp_file, 'wb') as fh:
+        fh.write(data)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.rename(tmp_file, filename)
+
+def filename_to_json(filename):
+    '''
+    a filename as found on disk, which needn't be utf-8 (e.g. from a FAT usb
+    stick), as a unicode string that json can store byte for byte
+    '''
+    return filename.decode('latin-1')
+
+def filename_from_json(name):
+    '''the filename stored by :func:`filename_to_json`'''
+    return name.encode('latin-1')
+
+# unicode braille patterns are U+2800 + pin number, which encodes to utf-8 as
+# '\xe2\xa0' followed by 0x80 + pin number for the 6 dot patterns
+_not_six_dot = re.compile(u'[^\u2800-\u283f]')
+_utf8_to_pin_table = ''.join(chr(max(0, i - 0x80)) for i in range(256))
+_pin_to_unicode_table = dict((pin_num, 0x2800 + pin_num) for pin_num in range(64))
+
+def unicodes_to_pin_nums(text):
+    '''
+    converts a row or page of unicode braille to a string of pin number bytes
+    in one pass. Anything that isn't one of the 6 dot braille patterns
+    U+2800 to U+283F becomes a blank cell.
+
+    :rtype: tuple of the pin number string and the number of characters that
+    were not 6 dot braille
+    '''
+    text = unicode(text)
+    invalid = len(_not_six_dot.findall(text))
+    if invalid:
+        text = _not_six_dot.sub(u'\u2800', text)
+    return text.encode('utf-8')[2::3].translate(_utf8_to_pin_table), invalid
+
 def unicode_to_pin_num(uni_char):
     '''
     converts a unicode braille character to a decimal number that can then be used to load a picture to display the character
     used to convert PEF format to CANUTE format
     http://en.wikipedia.org/wiki/Braille_Patterns
     '''
-    int_code = ord(uni_char) - 10240
-    pin_num = 0
-    pins = [0]*6
-    if int_code >= 0x20:
-        int_code -= 0x20
-        pins[5] = 1
-        pin_num += 32
-    if int_code >= 0x10:
-        int_code -= 0x10
-        pins[4] = 1
-        pin_num += 16
-    if int_code >= 0x8:
-        int_code -= 0x8
-        pins[3] = 1
-        pin_num += 8
-    if int_code >= 0x4:
-        int_code -= 0x4
-        pins[2] = 1
-        pin_num += 4
-    if int_code >= 0x2:
-        int_code -= 0x2
-        pins[1] = 1
-        pin_num += 2
-    if int_code >= 0x1:
-        int_code -= 0x1
-        pins[0] = 1
-        pin_num += 1
-
-    return pin_num
+    pin_nums, invalid = unicodes_to_pin_nums(uni_char)
+    if invalid:
+        log.warning("problem converting char #[%s] to pin number" % ord(uni_char))
+    return ord(pin_nums)
 
 '''
 used by the gui to display braille
@@ -85,10 +136,13 @@ used by the gui to display braille
 def pin_num_to_unicode(pin_num):
     return unichr(pin_num+10240)
 
+def pin_nums_to_unicode(pin_nums):
+    '''convert a row of pin numbers to a unicode braille string in one go'''
+    return str(bytearray(pin_nums)).decode('latin-1').translate(_pin_to_unicode_table)
+
 ''' for sorting & debugging '''
 def pin_num_to_alpha(numeric):
-    mapping = " A1B'K2L@CIF/MSP\"E3H9O6R^DJG>NTQ,*5<-U8V.%[$+X!&;:4\\0Z7(_?W]#Y)="
-    return mapping[numeric]
+    return BRAILLE_ASCII[numeric]
 
 def pin_nums_to_alphas(numerics):
     return map(pin_num_to_alpha, numerics)
@@ -100,11 +154,9 @@ def alpha_to_pin_num(alpha):
     will raise Formfeed or Linefeed ConversionExceptions if they are found
     other unknown characters will be logged and a space will be returned.
     '''
-    # mapping from http://en.wikipedia.org/wiki/Braille_ASCII#Braille_ASCII_values
-    mapping = " A1B'K2L@CIF/MSP\"E3H9O6R^DJG>NTQ,*5<-U8V.%[$+X!&;:4\\0Z7(_?W]#Y)="
     alpha = alpha.upper()
     try:
-        return mapping.index(alpha)
+        return BRAILLE_ASCII.index(alpha)
     except ValueError:
         # form feed
         if ord(alpha) == 12: